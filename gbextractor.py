@@ -8,61 +8,2980 @@
 # bitstring (3.1.7) - Simple construction, analysis and modification of binary data. https://github.com/scott-griffiths/bitstring
 # MIDIUtil (1.2.1) - A pure python library for creating multi-track MIDI files. https://github.com/MarkCWirt/MIDIUtil
 # https://midiutil.readthedocs.io/en/1.2.1/class.html#classref
+# MIDIUtil is now optional as MIDI files are written by SMFWriter unless bMidiUtilWriter is set.
+# bitstring is now optional as it is only used by the reference decoder, see bReferenceDecoder.
 
-import xml.etree.ElementTree as ET
+import copy
+import hashlib
+import importlib.util
+import io
+import json
 import os
+import binascii
 import base64
+import mmap
+import threading
+import re
 import sys
-from bitstring import ConstBitStream
+import struct
+from array import array
+from bisect import bisect_left
 import time
 import string
-from midiutil import MIDIFile
+
+# Anything that takes a while to import, or is only needed by some modes, is imported
+# when it is first used so that the script starts quickly and importing it does nothing
+# else.  bitstring is only needed by the reference decoder.  These are set by the load
+# functions below.
+np = None
+MIDIFile = None
+shared_memory = None
+
+def loadNumpy():
+  # numpy is optional and only needed for bNumpyDecoder.  Returns True if it is available.
+  global np, EVENT_DTYPE
+  if(np == None):
+    try:
+      import numpy
+    except ImportError:
+      return False
+    # One 16 byte row of a MIDI data block.  The fields overlap as their meaning depends
+    # on the command, e.g. valueA/valueB are velocity/note for a note on and duration is
+    # only meaningful in the second row of a note pair.
+    EVENT_DTYPE = numpy.dtype({"names": ["cmd", "time", "subCmd", "valueA", "valueB", "duration"],
+                               "formats": ["u1", "<u4", "u1", "u1", "u1", "<u4"],
+                               "offsets": [0, 4, 7, 11, 12, 12],
+                               "itemsize": EVENT_SIZE})
+    np = numpy
+  return True
+
+def loadMidiUtil():
+  # MIDIUtil is optional and only needed for bMidiUtilWriter.  Returns True if it is available.
+  global MIDIFile
+  if(MIDIFile == None):
+    try:
+      from midiutil import MIDIFile as midiFileClass
+    except ImportError:
+      return False
+    MIDIFile = midiFileClass
+  return True
+
+def loadSharedMemory():
+  # shared_memory is used to decode sections on several processes, which is not possible
+  # everywhere, e.g. Pythonista.  Returns True if it is available.
+  global shared_memory
+  if(shared_memory == None):
+    try:
+      from multiprocessing import shared_memory as sharedMemoryModule
+    except ImportError:
+      return False
+    shared_memory = sharedMemoryModule
+  return True
 
 class MIDISection:
   def __init__(self, label, associatedMidiID, recordNumber):
     self.label = label
     self.associatedMidiID = associatedMidiID
     self.bHasMIDI = False
+    # Bytes of the MIDI file for this section once it has been decoded, until it is written
     self.midiData = None
+    self.bWritten = False
+    # Bytes of the analysis export of this section, the same way as midiData
+    self.analysisData = None
+    self.bAnalysisWritten = False
     self.recordNumber = recordNumber
+    # Set when incremental extraction finds the existing MIDI file is up to date
+    self.bUnchanged = False
 
-class MIDIEvent:
-  def __init__(self, time, velocity, note, unknown):
-    self.time = time
-    self.note = note
-    self.velocity = velocity
-    self.trackUsed = 0
-   
-class TwoPartEvent:
-  def __init__(self, time, valueA, valueB):
+class EventStore:
+  # The decoded MIDI events of one section, kept as one array per field rather than an
+  # object per event.  The decoders add to this and the MIDI writers read from it.  kind is
+  # one of EVENT_NOTE, EVENT_CC, EVENT_PRESSURE or EVENT_PITCH_BEND and time is in ticks
+  # from baseTime.  data1 is the note, controller or pressure, data2 the velocity,
+  # controller value or pitch wheel value, and duration is only used by notes.
+  COLUMNS = [("kinds", "B"), ("channels", "B"), ("times", "q"), ("data1", "B"),
+             ("data2", "h"), ("durations", "I"), ("tracks", "B")]
+  __slots__ = [columnName for columnName, typeCode in COLUMNS] + ["trackNames"]
+
+  def __init__(self):
+    for columnName, typeCode in EventStore.COLUMNS:
+      setattr(self, columnName, array(typeCode))
+    # (track, name) of each track named while decoding, as tracks are only named once a
+    # note has been given to them
+    self.trackNames = []
+
+  def add(self, kind, channel, time, data1, data2, duration = 0, track = 0):
+    self.kinds.append(kind)
+    self.channels.append(channel)
+    self.times.append(time)
+    self.data1.append(data1)
+    self.data2.append(data2)
+    self.durations.append(duration)
+    self.tracks.append(track)
+
+  def extend(self, columns):
+    # Adds many events at once from a dict of NumPy arrays or lists keyed by column name
+    eventCount = None
+    for columnName, typeCode in EventStore.COLUMNS:
+      values = columns.get(columnName)
+      if(values is None):
+        values = [0] * eventCount
+      elif(np != None and isinstance(values, np.ndarray)):
+        values = np.ascontiguousarray(values, dtype=typeCode).tobytes()
+        getattr(self, columnName).frombytes(values)
+        eventCount = len(values) // getattr(self, columnName).itemsize
+        continue
+      getattr(self, columnName).extend(values)
+      eventCount = len(values)
+
+  def removeDuplicates(self, duplicatePolicy, bDuplicateDuration = False):
+    # Removes events identical to an earlier one on the same tick and returns how many were
+    # removed.  Notes are identical if they have the same channel and note, and duration if
+    # bDuplicateDuration is set, and CC, pressure and pitch bend if they have the same
+    # channel, controller and value.  Controller events on the same tick with different
+    # values are all kept, in order, so the last of them stays in effect as it would have.
+    # duplicatePolicy is one of DUPLICATE_POLICIES and chooses which of a set of identical
+    # notes is kept, in the place of the first of them.  Events are indexed by a dict keyed
+    # on what makes them identical so this takes linear time however many events overlap.
+    # The key of each event is packed into an int, which hashes much faster than a tuple.
+    # data1 is a whole byte as the decoders do not mask it, and data2 is offset so that
+    # negative pitch bends pack into 14 bits.
+    eventKeys = [(((((eventTime << 3) | kind) << 4 | channel) << 8 | data1) << 14) | (0 if kind == EVENT_NOTE else data2 + 8192)
+                 for kind, channel, eventTime, data1, data2 in zip(self.kinds, self.channels, self.times, self.data1, self.data2)]
+    if(bDuplicateDuration):
+      eventKeys = [(eventKey << 32) | duration for eventKey, duration in zip(eventKeys, self.durations)]
+    # Built backwards so that each key ends up with the index of its first event
+    firstEvents = dict(zip(reversed(eventKeys), range(len(eventKeys) - 1, -1, -1)))
+    if(len(firstEvents) == len(eventKeys)):
+      return 0
+    keptEvents = sorted(firstEvents.values())
+    
+    if(duplicatePolicy != "drop"):
+      durations = self.durations
+      data2 = self.data2
+      keptPositions = {eventKeys[eventIndex]: keptPosition for keptPosition, eventIndex in enumerate(keptEvents)}
+      for eventIndex, eventKey in enumerate(eventKeys):
+        keptPosition = keptPositions[eventKey]
+        keptIndex = keptEvents[keptPosition]
+        if(keptIndex == eventIndex):
+          continue
+        # Identical controller events have the same value so only notes can differ
+        if(duplicatePolicy == "longest"):
+          bReplace = (durations[eventIndex] > durations[keptIndex])
+        else:
+          bReplace = (data2[eventIndex] > data2[keptIndex])
+        if(bReplace):
+          keptEvents[keptPosition] = eventIndex
+    
+    self.keepEvents(keptEvents)
+    return len(eventKeys) - len(keptEvents)
+
+  def thinControllers(self, valueTolerance = 0, timeTolerance = 0):
+    # Removes CC, pressure and pitch bend events that make no difference, or less than the
+    # tolerances, and returns how many were removed.  Each controller of each channel is
+    # a stream of its own.  An event is removed if its value is within valueTolerance of
+    # the last event kept, or if the next event is within timeTolerance ticks of the last
+    # event kept, so it would soon be replaced anyway.  valueTolerance is in steps of a 7
+    # bit value and pitch bends use the same fraction of their 14 bit range.  The first
+    # and last event of each stream are always kept, as is the event that sets the value
+    # when each note on that channel starts and ends.
+    # Controllers hold their value until the next event rather than ramping between
+    # events, so a line-fitting decimation such as Ramer-Douglas-Peucker would change
+    # what is played by more than its tolerance.  This keeps the played value within
+    # valueTolerance of the original, other than for up to timeTolerance ticks.
+    times = self.times
+    noteBoundaries = dict()
+    streams = dict()
+    for eventIndex, kind, channel, eventTime, controller, duration in zip(range(len(self.kinds)), self.kinds, self.channels,
+                                                                          times, self.data1, self.durations):
+      if(kind == EVENT_NOTE):
+        channelBoundaries = noteBoundaries.setdefault(channel, set())
+        channelBoundaries.add(eventTime)
+        channelBoundaries.add(eventTime + duration)
+      else:
+        streams.setdefault((kind, channel, controller if kind == EVENT_CC else 0), []).append(eventIndex)
+    
+    bDropped = bytearray(len(self.kinds))
+    for (kind, channel, controller), stream in streams.items():
+      # Events are decoded in time order but that is not relied on
+      stream.sort(key = times.__getitem__)
+      values = self.data1 if kind == EVENT_PRESSURE else self.data2
+      streamTolerance = valueTolerance * 128 if kind == EVENT_PITCH_BEND else valueTolerance
+      boundaries = sorted(noteBoundaries.get(channel, ()))
+      keptTime = times[stream[0]]
+      keptValue = values[stream[0]]
+      for position in range(1, len(stream) - 1):
+        eventIndex = stream[position]
+        eventTime = times[eventIndex]
+        nextTime = times[stream[position + 1]]
+        # Is this the value in effect at the start or end of a note?
+        boundaryPosition = bisect_left(boundaries, eventTime)
+        if(boundaryPosition == len(boundaries) or boundaries[boundaryPosition] >= nextTime):
+          if(abs(values[eventIndex] - keptValue) <= streamTolerance or nextTime - keptTime < timeTolerance):
+            bDropped[eventIndex] = 1
+            continue
+        keptTime = eventTime
+        keptValue = values[eventIndex]
+    
+    removedCount = bDropped.count(1)
+    if(removedCount > 0):
+      self.keepEvents([eventIndex for eventIndex, bEventDropped in enumerate(bDropped) if not bEventDropped])
+    return removedCount
+
+  def keepEvents(self, keptEvents):
+    # Keeps only the events with the given indexes, in the order given
+    for columnName, typeCode in EventStore.COLUMNS:
+      setattr(self, columnName, array(typeCode, map(getattr(self, columnName).__getitem__, keptEvents)))
+
+  def __len__(self):
+    return len(self.kinds)
+
+  def __getitem__(self, eventIndex):
+    return EventView(*[getattr(self, columnName)[eventIndex] for columnName, typeCode in EventStore.COLUMNS])
+
+  def __iter__(self):
+    return map(EventView, *[getattr(self, columnName) for columnName, typeCode in EventStore.COLUMNS])
+
+  def writeTo(self, midiFileData):
+    # Adds the events to a SMFWriter or MIDIUtil MIDIFile in the order they were decoded
+    for track, trackName in self.trackNames:
+      midiFileData.addTrackName(track, 0, trackName)
+    if(isinstance(midiFileData, SMFWriter)):
+      midiFileData.addEvents(self)
+      return
+    addNote = midiFileData.addNote
+    addControllerEvent = midiFileData.addControllerEvent
+    addChannelPressure = midiFileData.addChannelPressure
+    addPitchWheelEvent = midiFileData.addPitchWheelEvent
+    for kind, channel, eventTime, data1, data2, duration, track in zip(self.kinds, self.channels, self.times, self.data1,
+                                                                       self.data2, self.durations, self.tracks):
+      if(kind == EVENT_NOTE):
+        addNote(track, channel, data1, eventTime, duration, data2)
+      elif(kind == EVENT_CC):
+        addControllerEvent(track, channel, eventTime, data1, data2)
+      elif(kind == EVENT_PITCH_BEND):
+        addPitchWheelEvent(track, channel, eventTime, data2)
+      else:
+        addChannelPressure(track, channel, eventTime, data1)
+
+class EventView:
+  # One event of an EventStore, for code that is easier to write with an object per event
+  __slots__ = ["kind", "channel", "time", "data1", "data2", "duration", "track"]
+
+  def __init__(self, kind, channel, time, data1, data2, duration, track):
+    self.kind = kind
+    self.channel = channel
     self.time = time
-    self.valueA = valueA
-    self.valueB = valueB
-         
+    self.data1 = data1
+    self.data2 = data2
+    self.duration = duration
+    self.track = track
+
+class EventCache:
+  # The events of every section of a project as decoded by buildEventCache(), before any
+  # of the options that change them were applied, so that they can be written with
+  # different options without decoding the project again.  Each column is that of
+  # EventStore, other than tracks, holding the events of every section one after another
+  # and memory mapped from the cache file so that only what is used is read.
+  COLUMNS = EventStore.COLUMNS[:-1]
+
+  def __init__(self, header, columns, mappedFile, mappedView):
+    self.header = header
+    self.columns = columns
+    self.mappedFile = mappedFile
+    self.mappedView = mappedView
+
+  def getEvents(self, payloadIndex):
+    # Returns the columns of the events of one MIDI data block, see buildEventCache()
+    eventStart, eventCount = self.header["payloads"][payloadIndex]
+    return {columnName: column[eventStart:eventStart + eventCount] for columnName, column in self.columns.items()}
+
+  def close(self):
+    # The mapping can only be closed once nothing is looking at it.  The events of a
+    # section may still be held, by the traceback of an error raised while they were
+    # written, in which case the mapping is closed once they are let go of.
+    for column in self.columns.values():
+      column.release()
+    self.mappedView.release()
+    try:
+      self.mappedFile.close()
+    except BufferError:
+      pass
+
+class NSDataLoader:
+  # XMLParser target which decodes the base64 NS.data value as the parser passes it
+  # through in pieces, so that neither the encoded text nor a tree of the plist is
+  # ever held in memory.
+  def __init__(self, decodedBuffer):
+    self.decodedBuffer = decodedBuffer
+    self.decodedLength = 0
+    self.keyText = None
+    self.lastKey = None
+    self.pendingText = b""
+    # Expat passes the text a line at a time so lines are gathered up and decoded together
+    self.textPieces = []
+    self.textLength = 0
+    self.bInData = False
+    self.bFinished = False
+    # Time spent in base64 decoding, only measured when profiling
+    self.decodeTime = None
+
+  def start(self, tag, attrib):
+    if(tag == "key"):
+      self.keyText = ""
+    elif(tag == "data" and self.lastKey == "NS.data" and not self.bFinished):
+      self.bInData = True
+    self.lastKey = None
+
+  def data(self, text):
+    if(self.bInData):
+      self.textPieces.append(text)
+      self.textLength += len(text)
+      if(self.textLength >= DECODE_CHUNK_SIZE):
+        self.decodePieces()
+    elif(self.keyText != None):
+      self.keyText += text
+
+  def end(self, tag):
+    if(tag == "key"):
+      self.lastKey = self.keyText
+      self.keyText = None
+    elif(tag == "data" and self.bInData):
+      self.decodePieces()
+      if(self.pendingText):
+        raise ValueError("Incomplete base64 data")
+      self.bInData = False
+      self.bFinished = True
+
+  def close(self):
+    pass
+
+  def decodePieces(self):
+    text = "".join(self.textPieces)
+    self.textPieces = []
+    self.textLength = 0
+    if(self.decodeTime != None):
+      startTime = time.perf_counter()
+      self.decode(text)
+      self.decodeTime += time.perf_counter() - startTime
+    else:
+      self.decode(text)
+
+  def decode(self, text):
+    # Only whole groups of 4 base64 characters can be decoded, anything left over is
+    # kept for the next piece of text
+    encodedText = self.pendingText + text.encode("ascii", "ignore").translate(None, b" \t\r\n")
+    usableLength = len(encodedText) - (len(encodedText) % 4)
+    decodedChunk = binascii.a2b_base64(encodedText[:usableLength])
+    self.decodedBuffer[self.decodedLength:self.decodedLength + len(decodedChunk)] = decodedChunk
+    self.decodedLength += len(decodedChunk)
+    self.pendingText = encodedText[usableLength:]
+
+class SMFWriter:
+  # Standard MIDI File writer with the same interface as the parts of MIDIUtil's MIDIFile
+  # that are used here.  Each event is packed into a single int which sorts into the same
+  # order that MIDIUtil writes events in (tick, then event class, then insertion order),
+  # so the events arrive almost in order and the sort at write time is cheap.  The file is
+  # format 1 with tempo and time signature in an extra first track, as MIDIUtil writes it.
+  # removeDuplicates can be turned off, as for MIDIUtil, if the events have already had
+  # their duplicates removed.
+  def __init__(self, numTracks, ticksPerQuarterNote=960, removeDuplicates=True):
+    self.ticksPerQuarterNote = ticksPerQuarterNote
+    self.removeDuplicates = removeDuplicates
+    self.tracks = [[] for trackNumber in range(numTracks + 1)]
+    self.metaEvents = []
+    self.metaSeen = set()
+    self.eventCounter = 0
+
+  def addChannelEvent(self, track, tick, sortOrder, status, data1, data2):
+    self.tracks[track].append((tick << SMF_KEY_TICK_SHIFT) | (sortOrder << 56) | (self.eventCounter << 24) |
+                              (status << 16) | (data1 << 8) | data2)
+    self.eventCounter += 1
+
+  def addMetaEvent(self, track, tick, sortOrder, metaType, metaData, dedupeKey):
+    # Duplicate meta events are dropped as MIDIUtil does, keeping the first one added
+    if((track, tick, metaType, dedupeKey) in self.metaSeen):
+      self.eventCounter += 1
+      return
+    self.metaSeen.add((track, tick, metaType, dedupeKey))
+    self.addChannelEvent(track, tick, sortOrder, 0xFF, len(self.metaEvents) >> 8, len(self.metaEvents) & 0xFF)
+    self.metaEvents.append(bytes([0xFF, metaType]) + encodeVarLength(len(metaData)) + metaData)
+
+  def addNote(self, track, channel, pitch, time, duration, volume):
+    key = (time << SMF_KEY_TICK_SHIFT) | (SMF_ORDER_NOTE_ON << 56) | (self.eventCounter << 24) | ((0x90 | channel) << 16) | (pitch << 8) | volume
+    # A zero length note off is sorted after its note on rather than before it
+    offOrder = SMF_ORDER_NOTE_OFF if duration > 0 else SMF_ORDER_ZERO_NOTE_OFF
+    self.tracks[track + 1] += (key,
+                               key + (duration << SMF_KEY_TICK_SHIFT) + ((offOrder - SMF_ORDER_NOTE_ON) << 56) - (0x10 << 16))
+    self.eventCounter += 1
+
+  def addControllerEvent(self, track, channel, time, controller_number, parameter):
+    self.addChannelEvent(track + 1, time, SMF_ORDER_CHANNEL, 0xB0 | channel, controller_number, parameter)
+
+  def addChannelPressure(self, tracknum, channel, time, pressure_value):
+    self.addChannelEvent(tracknum + 1, time, SMF_ORDER_CHANNEL, 0xD0 | channel, pressure_value, 0)
+
+  def addPitchWheelEvent(self, track, channel, time, pitchWheelValue):
+    self.addChannelEvent(track + 1, time, SMF_ORDER_CHANNEL, 0xE0 | channel, (pitchWheelValue + 8192) & 0x7F, (pitchWheelValue + 8192) >> 7)
+
+  def addEvents(self, events):
+    # Adds every event of an EventStore, as calling addNote() etc. for each would, but
+    # without a method call per event
+    tracks = self.tracks
+    eventCounter = self.eventCounter
+    for kind, channel, tick, data1, data2, duration, track in zip(events.kinds, events.channels, events.times, events.data1,
+                                                                  events.data2, events.durations, events.tracks):
+      if(kind == EVENT_NOTE):
+        key = (tick << SMF_KEY_TICK_SHIFT) | (SMF_ORDER_NOTE_ON << 56) | (eventCounter << 24) | ((0x90 | channel) << 16) | (data1 << 8) | data2
+        offOrder = SMF_ORDER_NOTE_OFF if duration > 0 else SMF_ORDER_ZERO_NOTE_OFF
+        tracks[track + 1] += (key,
+                              key + (duration << SMF_KEY_TICK_SHIFT) + ((offOrder - SMF_ORDER_NOTE_ON) << 56) - (0x10 << 16))
+      else:
+        if(kind == EVENT_CC):
+          eventBytes = ((0xB0 | channel) << 16) | (data1 << 8) | data2
+        elif(kind == EVENT_PITCH_BEND):
+          eventBytes = ((0xE0 | channel) << 16) | (((data2 + 8192) & 0x7F) << 8) | ((data2 + 8192) >> 7)
+        else:
+          eventBytes = ((0xD0 | channel) << 16) | (data1 << 8)
+        tracks[track + 1].append((tick << SMF_KEY_TICK_SHIFT) | (SMF_ORDER_CHANNEL << 56) | (eventCounter << 24) | eventBytes)
+      eventCounter += 1
+    self.eventCounter = eventCounter
+
+  def addTrackName(self, track, time, trackName):
+    trackNameBytes = trackName.encode("ISO-8859-1", "replace")
+    self.addMetaEvent(track + 1, time, SMF_ORDER_META, 0x03, trackNameBytes, trackNameBytes)
+
+  def addTempo(self, track, time, tempo):
+    # Always written to the tempo track
+    microsecondsPerQuarter = int(60000000 / tempo)
+    self.addMetaEvent(0, time, SMF_ORDER_TEMPO, 0x51, microsecondsPerQuarter.to_bytes(4, "big")[1:], microsecondsPerQuarter)
+
+  def addTimeSignature(self, track, time, numerator, denominator, clocks_per_tick, notes_per_quarter=8):
+    # Always written to the tempo track.  MIDIUtil only keeps one per tick.
+    self.addMetaEvent(0, time, SMF_ORDER_META, 0x58, bytes([numerator, denominator, clocks_per_tick, notes_per_quarter]), None)
+
+  def closeTrack(self, trackEvents):
+    # Returns the events of a track in the order they are written.  As MIDIUtil does,
+    # a note on or channel pressure identical to one already at that tick is dropped (with
+    # the note off of a dropped note), unless removeDuplicates is off, and a note off found
+    # while the same note is playing more than once is moved back to the latest note on so
+    # that notes do not interleave.
+    trackEvents.sort()
+    removeDuplicates = self.removeDuplicates
+    closedEvents = []
+    playingNotes = dict()
+    tickEvents = set()
+    droppedNotes = set()
+    currentTick = None
+    bMovedNoteOff = False
+    for key in trackEvents:
+      tick = key >> SMF_KEY_TICK_SHIFT
+      if(tick != currentTick):
+        currentTick = tick
+        tickEvents.clear()
+      statusKind = (key >> 16) & 0xF0
+      if(statusKind == 0x90 or statusKind == 0xD0):
+        eventKey = key & 0xFFFF00
+        if(removeDuplicates):
+          if(eventKey in tickEvents):
+            if(statusKind == 0x90):
+              droppedNotes.add((key >> 24) & 0xFFFFFFFF)
+            continue
+          tickEvents.add(eventKey)
+        if(statusKind == 0x90):
+          playingNotes.setdefault(eventKey, []).append(tick)
+      elif(statusKind == 0x80):
+        if(droppedNotes and ((key >> 24) & 0xFFFFFFFF) in droppedNotes):
+          continue
+        noteTicks = playingNotes.get((key & 0xFFFF00) | 0x100000)
+        if(noteTicks):
+          if(len(noteTicks) > 1):
+            key = (noteTicks.pop() << SMF_KEY_TICK_SHIFT) | (key & SMF_KEY_EVENT_MASK)
+            bMovedNoteOff = True
+          else:
+            noteTicks.pop()
+      closedEvents.append(key)
+    if(bMovedNoteOff):
+      closedEvents.sort()
+    return closedEvents
+
+  def encodeTrack(self, trackEvents):
+    # Delta times and running status straight into a bytearray.  Meta events cancel
+    # running status.
+    trackData = bytearray()
+    previousTick = 0
+    runningStatus = None
+    for key in self.closeTrack(trackEvents):
+      tick = key >> SMF_KEY_TICK_SHIFT
+      deltaTime = tick - previousTick
+      if(deltaTime < 0):
+        # Events before zero are written at zero
+        deltaTime = 0
+        tick = previousTick
+      if(deltaTime < 0x80):
+        trackData.append(deltaTime)
+      else:
+        trackData += encodeVarLength(deltaTime)
+      previousTick = tick
+      status = (key >> 16) & 0xFF
+      if(status == 0xFF):
+        trackData += self.metaEvents[key & 0xFFFF]
+        runningStatus = None
+        continue
+      if(status != runningStatus):
+        trackData.append(status)
+        runningStatus = status
+      if((status & 0xF0) == 0xD0):
+        trackData.append((key >> 8) & 0xFF)
+      else:
+        trackData += (key & 0xFFFF).to_bytes(2, "big")
+    trackData += b"\x00\xFF\x2F\x00"
+    return trackData
+
+  def getBytes(self):
+    midiData = bytearray(b"MThd" + struct.pack(">LHHH", 6, 1, len(self.tracks), self.ticksPerQuarterNote))
+    for trackEvents in self.tracks:
+      trackData = self.encodeTrack(trackEvents)
+      midiData += b"MTrk" + struct.pack(">L", len(trackData))
+      midiData += trackData
+    return midiData
+
+  def writeFile(self, fileHandle):
+    fileHandle.write(self.getBytes())
+
+class ExtractError(Exception):
+  # Raised when a project cannot be extracted
+  pass
+
+class BlockDecodeError(ExtractError):
+  # Raised by the struct decoder for data it does not understand, with the byte offset
+  # and command of the event where it was found
+  def __init__(self, message, offset, midiCmd):
+    ExtractError.__init__(self, message)
+    self.offset = offset
+    self.midiCmd = midiCmd
+
+class ExtractOptions:
+  # Options for extractProject().  Anything not given defaults to the matching
+  # user-configurable parameter below.
+  def __init__(self, **overrides):
+    self.outputDir = None
+    self.bOverridePitchBend = bOverridePitchBend
+    self.pitchBendMultiplier = pitchBendMultiplier
+    self.bUniqueTracks = bUniqueTracks
+    self.trackLimit = trackLimit
+    self.bRenameTracks = bRenameTracks
+    self.trackMap = trackMap
+    self.baseTime = baseTime
+    self.bReferenceDecoder = bReferenceDecoder
+    self.bNumpyDecoder = bNumpyDecoder
+    self.decodeJobs = decodeJobs
+    self.bMidiUtilWriter = bMidiUtilWriter
+    self.bWriteDecodedData = bWriteDecodedData
+    self.bIncremental = bIncremental
+    self.bProfile = bProfile
+    self.selectSections = selectSections
+    self.eventClasses = eventClasses
+    self.duplicatePolicy = duplicatePolicy
+    self.bRecover = bRecover
+    self.bThinControllers = bThinControllers
+    self.identicalSections = identicalSections
+    self.thinValueTolerance = thinValueTolerance
+    self.thinTimeTolerance = thinTimeTolerance
+    self.bDuplicateDuration = bDuplicateDuration
+    self.outputFormat = outputFormat
+    self.writeJobs = writeJobs
+    self.analysisFormat = analysisFormat
+    self.renderProfiles = renderProfiles
+    self.profileNames = profileNames
+    # Called as progressCallback(sectionsDone, sectionCount, sectionLabel) after each section
+    # is decoded.  Must be a module level function if sections are decoded in parallel.
+    self.progressCallback = None
+    for optionName, optionValue in overrides.items():
+      if(not hasattr(self, optionName)):
+        raise TypeError("Unknown option {}".format(optionName))
+      setattr(self, optionName, optionValue)
+
+class ExtractResult:
+  def __init__(self, projectPath, outputDir):
+    self.projectPath = projectPath
+    self.outputDir = outputDir
+    self.songTempo = None
+    self.timeSignature = None
+    self.sectionLabels = []
+    self.midiFiles = []
+    self.unchangedFiles = []
+    # Files written by the analysis export, if options.analysisFormat was set
+    self.analysisFiles = []
+    # Errors stepped over by recovery mode, see addDiagnostic(), and the number of
+    # sections which could not be extracted because of them
+    self.diagnostics = []
+    self.failedSections = 0
+    # MIDI filename of each section whose data was identical to another's, and that
+    # section's filename, if options.identicalSections is "alias"
+    self.aliases = dict()
+    # CC, pressure and pitch bend events before and after options.bThinControllers
+    # thinned them
+    self.controllerEvents = 0
+    self.thinnedControllerEvents = 0
+    # The zip or MIDI file holding every section if outputFormat is not "files"
+    self.archiveFile = None
+    # ExtractResult of each render profile written, if options.profileNames was set, whose
+    # files are also listed above as <profile>/<filename>
+    self.profiles = dict()
+    self.error = None
+    self.elapsed = None
+    # Report from ExtractProfile.toReport() if options.bProfile was set
+    self.profile = None
+
+  def toSummary(self):
+    return {"project": self.projectPath,
+            "outputDir": self.outputDir,
+            "tempo": self.songTempo,
+            "timeSignature": self.timeSignature,
+            "sections": self.sectionLabels,
+            "midiFiles": self.midiFiles,
+            "unchangedFiles": self.unchangedFiles,
+            "analysisFiles": self.analysisFiles,
+            "failedSections": self.failedSections,
+            "diagnostics": self.diagnostics,
+            "aliases": self.aliases,
+            "controllerEvents": self.controllerEvents,
+            "thinnedControllerEvents": self.thinnedControllerEvents,
+            "archiveFile": self.archiveFile,
+            "profiles": {profileName: profileResult.toSummary() for profileName, profileResult in self.profiles.items()},
+            "error": self.error,
+            "elapsed": self.elapsed,
+            "profile": self.profile}
+
+class ExtractProfile:
+  # Event counts and phase timings collected for --profile.  Block decode and MIDI encode
+  # times are summed over all sections so with parallel decoding they can add up to more
+  # than the parallelDecode wall-clock time.
+  def __init__(self):
+    self.phaseTimes = dict()
+    self.opcodeCounts = [0] * 256
+    self.sectionCount = 0
+
+  def addTime(self, phase, seconds):
+    self.phaseTimes[phase] = self.phaseTimes.get(phase, 0.0) + seconds
+
+  def merge(self, otherProfile):
+    for phase, seconds in otherProfile.phaseTimes.items():
+      self.addTime(phase, seconds)
+    for midiCmd, eventCount in enumerate(otherProfile.opcodeCounts):
+      self.opcodeCounts[midiCmd] += eventCount
+    self.sectionCount += otherProfile.sectionCount
+
+  def toReport(self):
+    # Bytes are counted from the size of each command as the decoders step over them.  The
+    # command that ends a block is counted but its bytes are not.
+    families = dict()
+    for midiCmd, eventCount in enumerate(self.opcodeCounts):
+      if(eventCount == 0):
+        continue
+      eventKind = EVENT_KIND_TABLE[midiCmd]
+      family = families.setdefault(EVENT_FAMILY_NAMES[eventKind], {"events": 0, "bytes": 0})
+      family["events"] += eventCount
+      if(eventKind != EVENT_END):
+        family["bytes"] += eventCount * EVENT_LENGTHS[midiCmd]
+    return {"phases": {phase: round(seconds, 6) for phase, seconds in self.phaseTimes.items()},
+            "sections": self.sectionCount,
+            "events": sum(self.opcodeCounts),
+            "families": families,
+            "opcodes": {"0x{:02X}".format(midiCmd): eventCount for midiCmd, eventCount in enumerate(self.opcodeCounts) if eventCount > 0}}
+
+class ExtractContext:
+  # State for one extraction, kept here rather than in module globals so that
+  # extractions cannot affect each other
+  def __init__(self, options):
+    self.options = options
+    self.baseTime = options.baseTime
+    self.trackCounter = 0
+    self.trackDict = dict()
+    self.songTempo = None
+    self.numerator = None
+    self.denominator = None
+    self.outputDir = None
+    # Manifest entries from the previous incremental extraction and for this one
+    self.previousManifest = None
+    self.manifest = dict()
+    self.profile = ExtractProfile() if options.bProfile else None
+    # Set by extractProject() so that each section is written as soon as it is decoded
+    # rather than all of them being kept in memory until the end
+    self.sectionWriter = None
+    self.sectionsDone = 0
+    self.sectionCount = 0
+    # Errors stepped over when options.bRecover is set
+    self.diagnostics = []
+    # [before, after] counts of the controller events thinned by options.bThinControllers
+    self.thinnedCounts = [0, 0]
+    # With options.identicalSections, the sections whose data is identical to that of
+    # each section being decoded, keyed by id() of that section, and the section being
+    # decoded for each of them
+    self.identicalSections = dict()
+    self.identicalTo = dict()
+    # Set along with sectionWriter, see isLinkingIdentical()
+    self.bLinkIdentical = False
+    self.bNumpyDecoder = options.bNumpyDecoder
+    if(self.bNumpyDecoder and not loadNumpy()):
+      print("WARN: numpy is not installed, using the struct decoder instead")
+      self.bNumpyDecoder = False
+    elif(self.bNumpyDecoder and bDebug):
+      # The NumPy decoder does not print per-event debug
+      debugPrint("Using the struct decoder for debugging")
+      self.bNumpyDecoder = False
+    self.bMidiUtilWriter = options.bMidiUtilWriter
+    if(self.bMidiUtilWriter and not loadMidiUtil()):
+      print("WARN: MIDIUtil is not installed, using the built-in MIDI writer instead")
+      self.bMidiUtilWriter = False
+    self.decodeJobs = options.decodeJobs
+    self.parallelDecodeThreshold = PARALLEL_DECODE_THRESHOLD
+    if(self.decodeJobs == None):
+      self.decodeJobs = os.cpu_count() or 1
+    if(bIsPythonista or bDebug or options.bReferenceDecoder or (self.decodeJobs > 1 and not loadSharedMemory())):
+      # Sections are decoded one after another so that debug output stays in order and
+      # the reference decoder can use its single bitstream
+      self.decodeJobs = 1
+    self.sectionFilter = compileSectionFilter(options.selectSections)
+    if(options.outputFormat not in OUTPUT_FORMATS):
+      raise ExtractError("ERROR: Unknown output format {}, expected one of {}".format(options.outputFormat, ", ".join(OUTPUT_FORMATS)))
+    if(options.bIncremental and options.outputFormat != "files"):
+      raise ExtractError("ERROR: Incremental extraction can only write separate MIDI files")
+    if(options.analysisFormat != None):
+      if(options.analysisFormat not in ANALYSIS_FORMATS):
+        raise ExtractError("ERROR: Unknown analysis format {}, expected one of {}".format(options.analysisFormat, ", ".join(ANALYSIS_FORMATS)))
+      if(options.bIncremental):
+        raise ExtractError("ERROR: Incremental extraction cannot export analysis data")
+      if(options.analysisFormat == "npz" and not loadNumpy()):
+        raise ExtractError("ERROR: numpy must be installed to export analysis data as npz")
+    elif(options.outputFormat == "none"):
+      raise ExtractError("ERROR: Output format none writes nothing without an analysis format")
+    if(options.eventClasses != None):
+      for eventClass in options.eventClasses:
+        if(eventClass not in SELECTABLE_EVENT_CLASSES):
+          raise ExtractError("ERROR: Unknown event class {}, expected one of {}".format(eventClass, ", ".join(SELECTABLE_EVENT_CLASSES)))
+      if("note" not in options.eventClasses and self.baseTime == None):
+        raise ExtractError("ERROR: baseTime must be set when notes are not extracted")
+    if(options.identicalSections != None):
+      if(options.identicalSections not in IDENTICAL_SECTION_MODES):
+        raise ExtractError("ERROR: Unknown identical section mode {}, expected one of {}".format(options.identicalSections, ", ".join(IDENTICAL_SECTION_MODES)))
+      if(options.identicalSections == "alias" and options.bIncremental):
+        raise ExtractError("ERROR: Incremental extraction cannot alias identical sections")
+    if(options.duplicatePolicy != None and options.duplicatePolicy not in DUPLICATE_POLICIES):
+      raise ExtractError("ERROR: Unknown duplicate policy {}, expected one of {}".format(options.duplicatePolicy, ", ".join(DUPLICATE_POLICIES)))
+    self.eventKinds = buildEventKindTable(options.eventClasses)
+    # Notes repeating the one before are dropped by the decoders unless every duplicate is
+    # removed later, or the events are being cached before any options are applied
+    self.bAdjacentNoteWorkaround = (options.duplicatePolicy == None)
+    if(self.bNumpyDecoder):
+      self.numpyEventKinds = np.array(self.eventKinds, dtype=np.uint8)
+
+def compileSectionFilter(selectSections):
+  # Returns a list of (record number and/or MIDI ID, label regular expression) for each
+  # --select pattern, or None to select every section.  A pattern of digits, or two
+  # groups of digits separated by a colon, is a record number, MIDI ID or hash key.
+  if(not selectSections):
+    return None
+  sectionFilter = []
+  for pattern in selectSections:
+    if(re.fullmatch(r"\d+(:\d+)?", pattern)):
+      sectionFilter.append((pattern, None))
+    else:
+      try:
+        sectionFilter.append((None, re.compile(pattern, re.IGNORECASE)))
+      except re.error as ex:
+        raise ExtractError("ERROR: Bad section pattern {} ({})".format(pattern, ex))
+  return sectionFilter
+
+def isSectionSelected(sectionFilter, midiSection):
+  if(sectionFilter == None):
+    return True
+  for sectionID, labelPattern in sectionFilter:
+    if(sectionID != None):
+      if(sectionID in (str(midiSection.recordNumber), str(midiSection.associatedMidiID),
+                       createKey(midiSection.recordNumber, midiSection.associatedMidiID))):
+        return True
+    elif(labelPattern.search(midiSection.label)):
+      return True
+  return False
+
+class SectionWriter:
+  # Writes the MIDI of each section as soon as it is decoded.  Files are written by a pool
+  # of writeJobs threads so that slow storage such as iCloud Drive does not hold up
+  # decoding.  With outputFormat "zip" the files are written one after another to a
+  # single zip, and with "smf" the tracks of every section are kept and written as one
+  # multi-track MIDI file by close().  With "none" no MIDI is written.  Analysis exports
+  # go into the zip with "zip" and are written as separate files otherwise.
+  def __init__(self, outputDir, outputFormat, archiveName, writeJobs, profile):
+    self.outputDir = outputDir
+    self.outputFormat = outputFormat
+    self.archivePath = None
+    if(outputFormat in ("zip", "smf")):
+      self.archivePath = os.path.join(outputDir, archiveName + (".zip" if outputFormat == "zip" else ".mid"))
+    self.profile = profile
+    self.writeTime = 0.0
+    self.timeLock = threading.Lock()
+    self.archiveFile = None
+    # (section, MIDI file bytes) kept for "smf" until close()
+    self.sectionData = []
+    self.pendingWrites = []
+    # Number of pendingWrites at the start of the list that are known to have finished
+    self.finishedWrites = 0
+    self.maxQueuedWrites = WRITE_QUEUE_DEPTH * max(writeJobs, 1)
+    # (filename, filename of the identical section) to link once everything is written
+    self.pendingLinks = []
+    self.bWritten = False
+    self.executor = None
+    if(writeJobs > 0):
+      import concurrent.futures
+      # A zip can only be written by one thread at a time
+      self.executor = concurrent.futures.ThreadPoolExecutor(max_workers = 1 if outputFormat == "zip" else writeJobs)
+
+  def write(self, midiSection, midiData):
+    self.bWritten = True
+    if(self.outputFormat == "smf"):
+      self.sectionData.append((midiSection, midiData))
+    else:
+      self.writeFile(getMidiFilename(midiSection), midiData)
+  
+  def writeFile(self, filename, fileData):
+    if(self.executor != None):
+      # Waits for the oldest write once too many are queued, so that decoding cannot run
+      # ahead of slow storage with the data of every section waiting in memory.  Errors
+      # are raised by close().
+      while(len(self.pendingWrites) - self.finishedWrites >= self.maxQueuedWrites):
+        self.pendingWrites[self.finishedWrites].exception()
+        self.finishedWrites += 1
+      self.pendingWrites.append(self.executor.submit(self.writeSection, filename, fileData))
+    else:
+      self.writeSection(filename, fileData)
+
+  def link(self, filename, originalFilename):
+    self.pendingLinks.append((filename, originalFilename))
+  
+  def writeSection(self, filename, midiData):
+    startTime = time.perf_counter()
+    if(self.outputFormat == "zip"):
+      if(self.archiveFile == None):
+        import zipfile
+        # Stored rather than compressed so that writing the zip costs no more than the
+        # MIDI files would
+        self.archiveFile = zipfile.ZipFile(self.archivePath, "w", zipfile.ZIP_STORED)
+      self.archiveFile.writestr(filename, midiData)
+    else:
+      filePath = os.path.join(self.outputDir, filename)
+      # A file left by an earlier run may be hard linked to that of an identical section,
+      # see link(), so it is replaced rather than written over
+      if(os.path.lexists(filePath)):
+        os.remove(filePath)
+      # 'with open' means Python will automatically close the file
+      with open(filePath, "wb") as output_file:
+        output_file.write(midiData)
+    with self.timeLock:
+      self.writeTime += time.perf_counter() - startTime
+
+  def close(self, sectionOrder = None):
+    # Waits for the outstanding writes and raises ExtractError if any of them failed.
+    # sectionOrder is the list of sections in the order their tracks are written to "smf".
+    try:
+      for pendingWrite in self.pendingWrites:
+        try:
+          pendingWrite.result()
+        except OSError as ex:
+          raise ExtractError("ERROR: Could not write MIDI ({})".format(ex))
+      for filename, originalFilename in self.pendingLinks:
+        linkPath = os.path.join(self.outputDir, filename)
+        try:
+          if(os.path.lexists(linkPath)):
+            os.remove(linkPath)
+          try:
+            os.link(os.path.join(self.outputDir, originalFilename), linkPath)
+          except OSError:
+            # Not every file system has hard links, e.g. iCloud Drive
+            import shutil
+            shutil.copyfile(os.path.join(self.outputDir, originalFilename), linkPath)
+        except OSError as ex:
+          raise ExtractError("ERROR: Could not write MIDI ({})".format(ex))
+      if(self.outputFormat == "smf" and len(self.sectionData) > 0):
+        sectionIndex = {id(midiSection): index for index, midiSection in enumerate(sectionOrder or [])}
+        self.sectionData.sort(key = lambda section: sectionIndex.get(id(section[0]), len(sectionIndex)))
+        startTime = time.perf_counter()
+        try:
+          with open(self.archivePath, "wb") as output_file:
+            output_file.write(mergeMidiFiles([midiData for midiSection, midiData in self.sectionData]))
+        except OSError as ex:
+          raise ExtractError("ERROR: Could not write MIDI ({})".format(ex))
+        self.writeTime += time.perf_counter() - startTime
+    finally:
+      self.abort()
+    if(not self.bWritten):
+      # No section had any MIDI so there is no zip or MIDI file
+      self.archivePath = None
+    if(self.profile != None): self.profile.addTime("fileWrite", self.writeTime)
+
+  def abort(self):
+    # Stops writing, e.g. because decoding failed, leaving whatever was already written
+    if(self.executor != None):
+      self.executor.shutdown(wait = True)
+      self.executor = None
+    if(self.archiveFile != None):
+      self.archiveFile.close()
+      self.archiveFile = None
+    self.sectionData = []
+
 def quitWithError(errorString):
   print(errorString)
   if bIsPythonista:
+    import console
     console.hud_alert(errorString, 'error', 2)
   sys.exit(1)
   
+def getMidiFilename(midiSection):
+  return "{}-{}_{}.mid".format(midiSection.label, str(midiSection.recordNumber), str(midiSection.associatedMidiID))
+
+def getAnalysisFilename(midiSection, analysisFormat):
+  return os.path.splitext(getMidiFilename(midiSection))[0] + "." + analysisFormat
+
+def getProjectName(projectPath):
+  return os.path.splitext(os.path.basename(projectPath.rstrip(os.sep)))[0]
+
+def getStableOutputDir(projectPath):
+  # Output directory used for incremental extraction, which must be the same every run
+  return "GB_Extract_" + getProjectName(projectPath)
+
+def getSectionDigest(context, midiSection, blockData):
+  # Digest of everything that affects the MIDI written for a section: the raw data
+  # block, the options used to decode it and the project tempo and time signature
+  options = context.options
+  decodeSettings = [MANIFEST_VERSION, midiSection.label, context.songTempo, context.numerator, context.denominator,
+                    context.baseTime, options.bOverridePitchBend, options.pitchBendMultiplier, options.bUniqueTracks,
+                    options.trackLimit, options.bRenameTracks, sorted(options.trackMap.items()), options.bMidiUtilWriter,
+                    sorted(options.eventClasses) if options.eventClasses != None else None,
+                    options.duplicatePolicy, options.bDuplicateDuration,
+                    [options.thinValueTolerance, options.thinTimeTolerance] if options.bThinControllers else None]
+  sectionDigest = hashlib.sha256(json.dumps(decodeSettings).encode("utf-8"))
+  sectionDigest.update(blockData)
+  return sectionDigest.hexdigest()
+
+def readManifest(outputDir):
+  # Returns the section entries of the manifest left by the last incremental
+  # extraction to outputDir, or an empty dict if there is not a usable one
+  try:
+    with open(os.path.join(outputDir, MANIFEST_FILENAME), "r") as manifestFile:
+      manifest = json.load(manifestFile)
+  except (OSError, ValueError):
+    return dict()
+  if(manifest.get("version") != MANIFEST_VERSION):
+    return dict()
+  return manifest.get("sections", dict())
+
+def writeManifest(outputDir, sections):
+  # Written to a temporary file first so that an interrupted run cannot leave a
+  # manifest which does not match the MIDI files
+  manifestPath = os.path.join(outputDir, MANIFEST_FILENAME)
+  with open(manifestPath + ".tmp", "w") as manifestFile:
+    json.dump({"version": MANIFEST_VERSION, "sections": sections}, manifestFile, indent = 2)
+  os.replace(manifestPath + ".tmp", manifestPath)
+
 def createKey(partA, partB):
   return "{}:{}".format(str(partA), str(partB))
 
-def debugPrint(stringToPrint):
-  if(bDebug): print(stringToPrint)
+def debugPrint(stringToPrint, *formatArgs):
+  # The string is only formatted when debugging so that the arguments can be passed
+  # on the hot path without the cost of formatting them
+  if(bDebug):
+    print(stringToPrint.format(*formatArgs) if formatArgs else stringToPrint)
+
+def encodeVarLength(value):
+  # MIDI variable length quantity, 7 bits per byte with the most significant first
+  varLength = bytearray([value & 0x7F])
+  value >>= 7
+  while(value > 0):
+    varLength.insert(0, (value & 0x7F) | 0x80)
+    value >>= 7
+  return bytes(varLength)
+  
+def addNoteEvent(context, events, midiSection, midiChl, eventTime, velocity, note, duration, lastNoteIndex):
+  # Shared by the decoders so that they all produce identical MIDI.  Returns the index in
+  # events of the note that should be used as lastNoteIndex for the next note.
+  if(context.baseTime == None):
+    context.baseTime = eventTime
+  eventTime -= context.baseTime
+  
+  # Try and work around duplicate note bug https://github.com/MarkCWirt/MIDIUtil/issues/24
+  # This is also done for SMFWriter so that both writers give the same MIDI.  With a
+  # duplicate policy every duplicate is removed once the whole section is decoded instead.
+  if(lastNoteIndex != None and context.bAdjacentNoteWorkaround):
+    if(events.data1[lastNoteIndex] == note and
+       events.times[lastNoteIndex] == eventTime):
+      return lastNoteIndex
+  
+  # Default track zero
+  trackToUse = 0
+  if(context.options.bUniqueTracks):
+    trackToUse = getTrackForNote(context, events, midiSection, note)
+            
+  events.add(EVENT_NOTE, midiChl, eventTime, note, velocity, duration, trackToUse)
+  if bDebug: debugPrint("{}", {"time": eventTime, "note": note, "velocity": velocity, "duration": duration, "trackUsed": trackToUse})
+  midiSection.bHasMIDI = True
+  return len(events) - 1
+
+def getTrackForNote(context, events, midiSection, note):
+  options = context.options
+  trackToUse = context.trackDict.get(note)
+  if(trackToUse == None):
+    trackToUse = context.trackCounter
+    context.trackDict[note] = trackToUse
+    trackName = getTrackName(options, midiSection, note)
+    events.trackNames.append((trackToUse, trackName))
+    context.trackCounter += 1
+    
+    if(options.trackLimit != None and context.trackCounter >= options.trackLimit):
+      debugPrint("Resetting track counter")
+      context.trackCounter = 0
+      
+    debugPrint("trackToUse {} {}", trackToUse, trackName)
+  return trackToUse
+
+def getTrackName(options, midiSection, note):
+  noteName = None
   
+  # Track name appended with mapped instrument name or MIDI note number
+  if(options.bRenameTracks):
+    noteName = options.trackMap.get(note)
+  
+  if(noteName == None):
+    noteName = str(note)
+    
+  return noteName + "_" + midiSection.label + "-" + str(midiSection.recordNumber) + "_" + str(midiSection.associatedMidiID) + "_" + noteName
+
+def addPitchBendEvent(context, events, midiSection, midiChl, eventTime, valueA, valueB):
+  pb = 0
+  pb = (pb << 7) + (valueA & 0x7F)
+  pb = (pb << 7) + (valueB & 0x7F)
+  pitchWheelValue = -8192 + pb
+
+  if(context.options.bOverridePitchBend):
+    pitchWheelValue *= context.options.pitchBendMultiplier
+    # Correct any overshoot
+    if(pitchWheelValue < -8192): pitchWheelValue = -8192
+    if(pitchWheelValue > 8191): pitchWheelValue = 8191
+    debugPrint("Adjusted pitchWheelValue is: {0}({0:#x})", pitchWheelValue)
+
+  events.add(EVENT_PITCH_BEND, midiChl, eventTime - context.baseTime, 0, pitchWheelValue)
+  midiSection.bHasMIDI = True
+
+def noBaseTimeError(offset, midiCmd):
+  # With baseTime None the times are relative to the first note, so an event before it
+  # cannot be placed
+  return BlockDecodeError("ERROR: Event before the first note with no baseTime", offset, midiCmd)
+
 def readTwoPartEvent(bitStream):
   bitStream.read("bytes:3")
   eventTime = bitStream.read("uintle:32")
   bitStream.read("bytes:3")
   eventValueA = bitStream.read("uintle:8")
   eventValueB = bitStream.read("uintle:8")
-  debugPrint("eventValueA {}({}) eventValueB {}({})".format(eventValueA, hex(eventValueA), eventValueB, hex(eventValueB)))
+  debugPrint("eventValueA {0}({0:#x}) eventValueB {1}({1:#x})", eventValueA, eventValueB)
   bitStream.read("bytes:3")  
-  return TwoPartEvent(eventTime, eventValueA, eventValueB)
+  return eventTime, eventValueA, eventValueB
+
+def loadProjectData(pathToGBFile, profile = None):
+  # Streams the projectData plist and returns its decoded NS.data as a buffer, or None
+  # if there is no NS.data.  The decoded data is never larger than 3/4 of the file so
+  # that much space is allocated up front.
+  decodedSize = (os.path.getsize(pathToGBFile) * 3) // 4 + 3
+  if(decodedSize > DECODED_MMAP_THRESHOLD):
+    import tempfile
+    with tempfile.TemporaryFile() as tempFile:
+      tempFile.truncate(decodedSize)
+      decodedBuffer = mmap.mmap(tempFile.fileno(), decodedSize)
+  else:
+    decodedBuffer = bytearray(decodedSize)
+  
+  import xml.etree.ElementTree as ET
+  loader = NSDataLoader(decodedBuffer)
+  if(profile != None):
+    loader.decodeTime = 0.0
+    startTime = time.perf_counter()
+  xmlParser = ET.XMLParser(target=loader)
+  with open(pathToGBFile, "rb") as projectFile:
+    while not loader.bFinished:
+      xmlChunk = projectFile.read(LOAD_CHUNK_SIZE)
+      if(not xmlChunk):
+        break
+      xmlParser.feed(xmlChunk)
+  
+  if(profile != None):
+    profile.addTime("xmlParse", time.perf_counter() - startTime - loader.decodeTime)
+    profile.addTime("base64Decode", loader.decodeTime)
+  if(not loader.bFinished):
+    return None
+  debugPrint("Decoded {} bytes of project data", loader.decodedLength)
+  
+  if(isinstance(decodedBuffer, bytearray)):
+    del decodedBuffer[loader.decodedLength:]
+    return decodedBuffer
+  return memoryview(decodedBuffer)[:loader.decodedLength]
+
+def findRecordMarkers(buf, markers):
+  # Returns a list of (byte offset, marker) for every record marker in the data, in
+  # the order they appear.  The regular expression engine only stops at bytes which
+  # can start a marker so this is one pass regardless of how many markers there are.
+  markerPattern = re.compile(b"|".join(re.escape(marker) for marker in markers))
+  return [(match.start(), match.group()) for match in markerPattern.finditer(buf)]
+
+def readRecordHeaderBits(s, recordOffset):
+  s.pos = recordOffset * 8
+  recordType, recordSubType, recordNumber, recordMidiID, dataLength = s.readlist("pad:32, uintle:16, uintle:32, uintle:32, uintle:32, 2*pad:32, pad:16, uintle:32, pad:32")
+  # We are now at the start of the data so save this position for later...
+  return recordType, recordSubType, recordNumber, recordMidiID, dataLength, s.pos // 8
+
+def readRecordHeader(buf, recordOffset):
+  recordType, recordSubType, recordNumber, recordMidiID, dataLength = RECORD_HEADER.unpack_from(buf, recordOffset)
+  return recordType, recordSubType, recordNumber, recordMidiID, dataLength, recordOffset + RECORD_HEADER.size
+
+def readSectionHeaderBits(s, dataStart):
+  s.pos = (dataStart + 3) * 8
+  associatedMidiID, sectionNameLength = s.readlist("pad:40, uintle:32, pad:32, uintle:16")
+  return associatedMidiID, s.read("bytes:{}".format(str(sectionNameLength))).decode("utf-8")
+
+def readSectionHeader(buf, dataStart):
+  blockType, associatedMidiID, sectionNameLength = SECTION_HEADER.unpack_from(buf, dataStart)
+  nameStart = dataStart + SECTION_HEADER.size
+  return associatedMidiID, bytes(buf[nameStart:nameStart + sectionNameLength]).decode("utf-8")
+
+def decodeMidiBlockBits(context, s, dataStart, dataLength, midiSection, events):
+  # Reference decoder which reads each field from a bitstring.  This is much slower
+  # than decodeMidiBlock() but is kept to validate it.
+  lastNoteIndex = None
+        
+  s.pos = dataStart * 8
+  dataStart = s.pos
+  eventKinds = context.eventKinds
+  opcodeCounts = context.profile.opcodeCounts if context.profile != None else None
+  
+  while True:
+    # Read in the next command byte
+    midiCmd = s.read('uintle:8')
+    if(opcodeCounts != None): opcodeCounts[midiCmd] += 1
+    debugPrint('Command is {0} ({0:#x})', midiCmd)
+    
+    midiChl = midiCmd & 0x0F
+    
+    if(midiCmd >= 0x90 and midiCmd <= 0x9F): # Note on/off event
+      # 0x00000000 | 90 00 00 00 00 96 00 00 00 00 00 7D 24 00 00 00 | ...........}$...
+      # 0x00000010 | 80 00 00 00 00 00 00 89 00 00 00 00 F0 00 00 00 | ................
+      
+      eventTime, velocity, note = s.readlist('pad:24, uintle:32, pad:24, uintle:8, uintle:8, pad:24')
+      s.read("bytes:7")
+      
+      midiCmd = s.read('uintle:8')
+      if(midiCmd >= 0x80 and midiCmd <= 0x8F): # Note Off event then set note duration event
+        # 0x00000580 | 40 00 00 00 00 00 00 89 00 00 00 00 F0 00 00 00 | @...............
+        # 0x00000590 | 00 00 00 00 00 00 00 A7 00 00 00 00 00 00 00 00 | ................
+        # 0x000005A0 | 90 00 00 00 53 BD 00 00 00 00 00 73 24 00 00 00 | ....S......s$...
+
+        extendedBytes = s.read("uintle:32")
+        # Duration spans at least 3, probably 4 bytes.  We'll go for 4 for now!
+        duration = s.read("uintle:32")
+        
+        if(eventKinds[0x90 | midiChl] == EVENT_NOTE):
+          lastNoteIndex = addNoteEvent(context, events, midiSection, midiChl, eventTime, velocity, note, duration, lastNoteIndex)
+                      
+        if(extendedBytes > 0):
+          debugPrint('Found extended bytes {:#x} ', extendedBytes)
+          
+      else: # Did not find expected 0x8x before note duration data
+        raise BlockDecodeError('ERROR: Unknown command {} ({})'.format(midiCmd, hex(midiCmd)), s.pos // 8 - 8, midiCmd)
+    elif ((midiCmd >= 0x00 and midiCmd <= 0x0A) or midiCmd == 0xFF): # internal commands/screen elements?
+      # 00 00 00 00 00 00 01 B5 00 00 00 00 00 00 00 00. button on? 01 on 02 off
+      s.read('bytes:6')
+      midiCmd = s.read('uintle:8')
+      if (midiCmd != 0xA8 and midiCmd != 0xA7 and midiCmd != 0xB5):
+        debugPrint('WARN: Unknown command {0} ({0:#x})', midiCmd)
+      s.read('bytes:8')
+    elif (midiCmd >= 0x20 and midiCmd <= 0x2F): # cc bank change ?
+      # 20 3D 01 00 00 00 00 A8 00 00 00 00 A5 83 00 00
+      s.read("bytes:15")
+    elif (midiCmd == 0x40): # cc sustain ?
+      # 40 2F 01 00 00 00 00 A8 00 00 00 00 A2 83 00 00
+      s.read("bytes:15")
+    elif (midiCmd >= 0x50 and midiCmd <= 0x5F): # cc general purpose controller, synth knobs 0x00-0x0b pads CA-CD
+      # 50 40 00 00 00 96 00 00 10 58 39 0E 00 01 00 01 # knob top left synth 00 
+      # 50 40 00 00 00 96 00 00 45 B6 D3 0C 01 01 00 01 # knob bottom left 01
+      # 50 40 00 00 00 96 00 00 00 00 00 7F 02 01 00 01 # knob top right 02
+      # 50 40 00 00 00 96 00 00 00 00 00 00 07 01 00 01 # knob bottom right 07
+      
+      if (midiCmd >= 0x51 and midiCmd <= 0x5F): # I do not think this is actually per-channel so validate this
+        raise BlockDecodeError("Unexpected 0x5x command {} ({})".format(midiCmd, hex(midiCmd)), s.pos // 8 - 1, midiCmd)
+      
+      eventTime, valueA, valueB = readTwoPartEvent(s)
+      
+      # It feels like program change, e.g. patch change in synth is implemented like this but GB does not respond
+      # so disabling this for now.
+      if(False and valueB & 0xC0 == 0xC0):
+        ctrlChl = valueB & 0x0F
+        debugPrint("Adding program change {} on channel {}", valueA, ctrlChl)
+        # EventStore would need a program change kind for this
+    
+    elif (midiCmd >= 0x70 and midiCmd <= 0x7F): # can be triggered by manually adding and moving percussion with smart drums while recording
+      # 70 00 00 00 00 96 00 00 00 00 00 01 36 00 00 00
+      # 09 00 02 06 00 00 00 A8 00 00 00 00 21 00 09 00
+      debugPrint("0x7x MIDI command {0} ({0:#x})", midiCmd)
+      s.read("bytes:31")
+    elif (midiCmd >= 0x80 and midiCmd <= 0x8F): # Do not know what this is. Seen with synth, not a note-off though as it uses the same bytes each time.
+      # 80 AE 01 00 00 00 00 A8 00 00 00 00 A5 83 00 00
+      s.read("bytes:15")
+    elif (midiCmd >= 0xA0 and midiCmd <= 0xAF): # polyphonic key pressure unsupported in MIDIUtil API :(
+      # A0 11 01 00 00 00 00 A8 00 00 00 00 A5 83 00 00
+      debugPrint("Polyphonic key pressure (unsupported) {0}({0:#x})", midiCmd)
+      s.read("bytes:15")
+    elif (midiCmd >= 0xB0 and midiCmd <= 0xBF): # MIDI CC
+      # B0 40 00 00 5D 9D 00 00 00 00 00 00 40 00 00 01 cc sustain off 00 40 ch 0 40 is cc val
+      # B0 40 00 00 5D 9D 00 00 00 00 00 7F 40 00 00 01 cc sus on 7F 40 ch 0
+      # 0 (to 63) is off. 127 (to 64) is on.
+      # B0 40 00 00 40 9A 00 00 00 00 00 00 01 00 00 01 cc mod wheel zero
+      
+      eventTime, valueA, valueB = readTwoPartEvent(s)
+      if(eventKinds[midiCmd] == EVENT_CC):
+        if(context.baseTime == None): raise noBaseTimeError(s.pos // 8 - EVENT_SIZE, midiCmd)
+        events.add(EVENT_CC, midiChl, eventTime - context.baseTime, valueB, valueA)
+        midiSection.bHasMIDI = True
+    elif (midiCmd >= 0xC0 and midiCmd <= 0xCF): # Should be program change but don't think it is 
+      # C0 03 01 00 00 00 00 A8 00 00 00 00 A5 83 00 00
+      s.read("bytes:15")
+    elif (midiCmd >= 0xD0 and midiCmd <= 0xDF): # channel pressure
+      # D3 40 00 00 81 A1 00 00 00 00 00 00 00 00 00 01 channel pressure 0
+      # D5 40 00 00 C4 BA 00 00 00 00 00 1F 1F 00 00 01 channel pressure 1F
+      
+      eventTime, valueA, valueB = readTwoPartEvent(s)
+      
+      if(valueA != valueB):
+        raise BlockDecodeError("Pressure value A ({}) != Pressure value B ({})".format(valueA, valueB), s.pos // 8 - EVENT_SIZE, midiCmd)
+
+      # This method does not appear to be documented but is in the MIDIUtil unit tests and the
+      # changelog says it was added in 1.2.1          
+      if(eventKinds[midiCmd] == EVENT_PRESSURE):
+        if(context.baseTime == None): raise noBaseTimeError(s.pos // 8 - EVENT_SIZE, midiCmd)
+        events.add(EVENT_PRESSURE, midiChl, eventTime - context.baseTime, valueA, 0)
+        midiSection.bHasMIDI = True       
+    elif (midiCmd >= 0xE0 and midiCmd <= 0xEF): # pitch bend
+      # E8 40 00 00 19 A0 00 00 00 00 00 40 17 00 00 01 pitch bend ch 8 val 40 17
+      # E4 40 00 00 41 9A 00 00 00 00 00 40 00 00 00 01 pitch bend 0
+      
+      eventTime, valueA, valueB = readTwoPartEvent(s)
+      if(eventKinds[midiCmd] == EVENT_PITCH_BEND):
+        if(context.baseTime == None): raise noBaseTimeError(s.pos // 8 - EVENT_SIZE, midiCmd)
+        addPitchBendEvent(context, events, midiSection, midiChl, eventTime, valueA, valueB)
+    elif (midiCmd == 0xF1):
+      debugPrint("Found end of buffer")
+      break
+    elif ((midiCmd >= 0x30 and midiCmd <= 0x3F) or
+           midiCmd == 0x60 or 
+           midiCmd == 0x11 or 
+           midiCmd == 0x12):
+      # These tend to be at the start of blocks we are not interested in
+      debugPrint("Unknown bytes: {:#x}", midiCmd)
+      break
+    else:
+      # Not seen this command byte before so dump some context for debugging
+      # purposes then exit.  Recovery mode keeps the dump in its diagnostic instead.
+      eventStart = s.pos // 8 - 1
+      if(not context.options.bRecover):
+        s.pos -= (64 * 8)
+        dumphex(68, s)
+      raise BlockDecodeError("Unrecognised command: {}".format(midiCmd), eventStart, midiCmd)
+
+    # Check we have not exceeded the length of the data in this block
+    bufferUsed = s.pos - dataStart
+    totalBufferSize = (dataLength * 8)
+    debugPrint("Buffer used so far: {} out of: {}", bufferUsed, totalBufferSize)
+    
+    if(bufferUsed > totalBufferSize):
+      raise BlockDecodeError("ERROR: Went past end of buffer.", (dataStart + totalBufferSize) // 8, None)
+      
+    if(bufferUsed == totalBufferSize):
+      debugPrint("Used full buffer")
+      break
+
+def decodeMidiBlock(context, buf, dataStart, dataLength, midiSection, events):
+  # Decodes a MIDI data block directly from the decoded bytes using the precompiled
+  # struct layouts.  This must stay in step with decodeMidiBlockBits().
+  lastNoteIndex = None
+  pos = dataStart
+  dataEnd = dataStart + dataLength
+  opcodeCounts = context.profile.opcodeCounts if context.profile != None else None
+  
+  # The command byte picks the event class and length from tables built once per
+  # extraction, so skipped events and classes which are not wanted cost one lookup
+  eventKinds = context.eventKinds
+  
+  while True:
+    midiCmd = buf[pos]
+    if(opcodeCounts != None): opcodeCounts[midiCmd] += 1
+    if bDebug: debugPrint('Command is {0} ({0:#x})', midiCmd)
+    
+    eventKind = eventKinds[midiCmd]
+    if(eventKind == EVENT_SKIP):
+      if bDebug: debugSkippedEvent(buf, pos, midiCmd)
+      pos += EVENT_LENGTHS[midiCmd]
+    elif(eventKind == EVENT_NOTE): # Note on/off event
+      midiCmd, eventTime, velocity, note, offCmd, extendedBytes, duration = NOTE_PAIR.unpack_from(buf, pos)
+      if(offCmd >= 0x80 and offCmd <= 0x8F): # Note Off event then set note duration event
+        lastNoteIndex = addNoteEvent(context, events, midiSection, midiCmd & 0x0F, eventTime, velocity, note, duration, lastNoteIndex)
+        if(bDebug and extendedBytes > 0):
+          debugPrint('Found extended bytes {:#x} ', extendedBytes)
+      else: # Did not find expected 0x8x before note duration data
+        raise BlockDecodeError('ERROR: Unknown command {} ({})'.format(offCmd, hex(offCmd)), pos + EVENT_SIZE, offCmd)
+      pos += NOTE_PAIR.size
+    elif(eventKind == EVENT_CC): # MIDI CC
+      eventTime, valueA, valueB = TWO_PART_EVENT.unpack_from(buf, pos)
+      if(context.baseTime == None): raise noBaseTimeError(pos, midiCmd)
+      events.add(EVENT_CC, midiCmd & 0x0F, eventTime - context.baseTime, valueB, valueA)
+      midiSection.bHasMIDI = True
+      pos += EVENT_SIZE
+    elif(eventKind == EVENT_PITCH_BEND):
+      eventTime, valueA, valueB = TWO_PART_EVENT.unpack_from(buf, pos)
+      if(context.baseTime == None): raise noBaseTimeError(pos, midiCmd)
+      addPitchBendEvent(context, events, midiSection, midiCmd & 0x0F, eventTime, valueA, valueB)
+      pos += EVENT_SIZE
+    elif(eventKind == EVENT_PRESSURE): # channel pressure
+      eventTime, valueA, valueB = TWO_PART_EVENT.unpack_from(buf, pos)
+      if(valueA != valueB):
+        raise BlockDecodeError("Pressure value A ({}) != Pressure value B ({})".format(valueA, valueB), pos, midiCmd)
+      if(context.baseTime == None): raise noBaseTimeError(pos, midiCmd)
+      events.add(EVENT_PRESSURE, midiCmd & 0x0F, eventTime - context.baseTime, valueA, 0)
+      midiSection.bHasMIDI = True
+      pos += EVENT_SIZE
+    elif(eventKind == EVENT_END):
+      if(midiCmd == 0xF1):
+        debugPrint("Found end of buffer")
+      else:
+        # These tend to be at the start of blocks we are not interested in
+        debugPrint("Unknown bytes: {:#x}", midiCmd)
+      break
+    elif(midiCmd >= 0x51 and midiCmd <= 0x5F):
+      raise BlockDecodeError("Unexpected 0x5x command {} ({})".format(midiCmd, hex(midiCmd)), pos, midiCmd)
+    else:
+      # Not seen this command byte before so dump some context for debugging
+      # purposes then exit.  Recovery mode keeps the dump in its diagnostic instead.
+      if(not context.options.bRecover): dumpbytes(buf, max(0, pos + 1 - 64), 68)
+      raise BlockDecodeError("Unrecognised command: {}".format(midiCmd), pos, midiCmd)
+
+    # Check we have not exceeded the length of the data in this block
+    if(pos > dataEnd):
+      raise BlockDecodeError("ERROR: Went past end of buffer.", dataEnd, None)
+      
+    if(pos == dataEnd):
+      debugPrint("Used full buffer")
+      break
+
+def debugSkippedEvent(buf, pos, midiCmd):
+  # Debug output for the events that decodeMidiBlock() steps over
+  if((midiCmd >= 0x00 and midiCmd <= 0x0A) or midiCmd == 0xFF): # internal commands/screen elements?
+    subCmd = buf[pos + 7]
+    if(subCmd != 0xA8 and subCmd != 0xA7 and subCmd != 0xB5):
+      debugPrint('WARN: Unknown command {0} ({0:#x})', subCmd)
+  elif(midiCmd == 0x50): # cc general purpose controller
+    eventTime, valueA, valueB = TWO_PART_EVENT.unpack_from(buf, pos)
+    debugPrint("eventValueA {0}({0:#x}) eventValueB {1}({1:#x})", valueA, valueB)
+  elif(midiCmd >= 0x70 and midiCmd <= 0x7F): # smart drums
+    debugPrint("0x7x MIDI command {0} ({0:#x})", midiCmd)
+
+def decodeMidiBlockNumpy(context, buf, dataStart, dataLength, midiSection, events):
+  # Decodes a whole MIDI data block with array operations.  If the block contains
+  # anything unexpected then False is returned before any MIDI is added so that the
+  # caller can fall back to decodeMidiBlock(), which will report the problem.
+  options = context.options
+  rowCount = (dataLength + EVENT_SIZE - 1) // EVENT_SIZE
+  if(rowCount == 0 or dataStart + rowCount * EVENT_SIZE > len(buf)):
+    return False
+  
+  rows = np.frombuffer(buf, dtype=EVENT_DTYPE, count=rowCount, offset=dataStart)
+  cmds = rows["cmd"]
+  
+  # Note pairs and 0x7x events take two rows.  A row is the second half of one of these
+  # if it follows an odd number of rows starting with 0x7x/0x9x, counting back to the
+  # last row that does not.
+  bLong = ((cmds & 0xF0) == 0x90) | ((cmds & 0xF0) == 0x70)
+  rowIndex = np.arange(rowCount)
+  lastShort = np.maximum.accumulate(np.where(bLong, -1, rowIndex))
+  longRun = rowIndex - 1 - np.concatenate(([-1], lastShort[:-1]))
+  starts = np.flatnonzero((longRun & 1) == 0)
+  
+  # Find the event which ends the block, either a terminator or one which uses the
+  # rest of the buffer
+  kinds = context.numpyEventKinds[cmds[starts]]
+  eventEnds = starts * EVENT_SIZE + np.where(bLong[starts], 2 * EVENT_SIZE, EVENT_SIZE)
+  bLast = (kinds <= EVENT_END) | (eventEnds >= dataLength)
+  lastEvent = int(np.argmax(bLast))
+  if(not bLast[lastEvent] or kinds[lastEvent] == EVENT_UNKNOWN):
+    return False
+  # The command that ends the block is counted by --profile
+  countedStarts = starts[:lastEvent + 1]
+  if(kinds[lastEvent] != EVENT_END):
+    if(eventEnds[lastEvent] > dataLength):
+      return False
+    lastEvent += 1
+  
+  starts = starts[:lastEvent]
+  kinds = kinds[:lastEvent]
+  eventRows = rows[starts]
+  
+  bNote = (kinds == EVENT_NOTE)
+  noteStarts = starts[bNote]
+  offCmds = rows["subCmd"][noteStarts + 1]
+  if(not ((offCmds & 0xF0) == 0x80).all()):
+    return False
+  
+  valueA = eventRows["valueA"]
+  valueB = eventRows["valueB"]
+  bPressure = (kinds == EVENT_PRESSURE)
+  if((valueA[bPressure] != valueB[bPressure]).any()):
+    return False
+  
+  eventTimes = eventRows["time"].astype(np.int64)
+  bEmitted = (kinds >= EVENT_NOTE)
+  emittedIndex = np.flatnonzero(bEmitted)
+  if(len(emittedIndex) == 0):
+    countNumpyEvents(context, cmds[countedStarts])
+    return True
+  
+  if(context.baseTime == None):
+    # The struct decoder raises an error for an event with no base time
+    if(kinds[emittedIndex[0]] != EVENT_NOTE):
+      return False
+    context.baseTime = int(eventTimes[emittedIndex[0]])
+  
+  relativeTimes = eventTimes - context.baseTime
+  
+  # Notes use the value column for duration and pitch bends for the 14 bit bend value
+  values = np.zeros(len(kinds), dtype=np.int64)
+  values[bNote] = rows["duration"][noteStarts + 1]
+  
+  bPitchBend = (kinds == EVENT_PITCH_BEND)
+  pitchWheelValues = (((valueA[bPitchBend] & 0x7F).astype(np.int64) << 7) + (valueB[bPitchBend] & 0x7F)) - 8192
+  if(options.bOverridePitchBend):
+    pitchWheelValues = np.clip(pitchWheelValues * options.pitchBendMultiplier, -8192, 8191)
+  values[bPitchBend] = pitchWheelValues
+  
+  # Work around the MIDIUtil duplicate note bug in the same way as addNoteEvent()
+  bDuplicate = np.zeros(len(kinds), dtype=bool)
+  if(context.bAdjacentNoteWorkaround):
+    noteIndex = np.flatnonzero(bNote)
+    bDuplicate[noteIndex[1:]] = ((valueB[noteIndex[1:]] == valueB[noteIndex[:-1]]) &
+                                 (eventTimes[noteIndex[1:]] == eventTimes[noteIndex[:-1]]))
+  emittedIndex = np.flatnonzero(bEmitted & ~bDuplicate)
+  emittedKinds = kinds[emittedIndex]
+  
+  # data1 is valueB (note or controller) except for pressure, and data2 is valueA (velocity
+  # or controller value) except for pitch bend
+  bEmittedPressure = (emittedKinds == EVENT_PRESSURE)
+  bEmittedPitchBend = (emittedKinds == EVENT_PITCH_BEND)
+  eventColumns = {"kinds": emittedKinds,
+                  "channels": rows["cmd"][starts[emittedIndex]] & 0x0F,
+                  "times": relativeTimes[emittedIndex],
+                  "data1": np.where(bEmittedPressure, valueA[emittedIndex], np.where(bEmittedPitchBend, 0, valueB[emittedIndex])),
+                  "data2": np.where(bEmittedPitchBend, values[emittedIndex], np.where(bEmittedPressure, 0, valueA[emittedIndex])),
+                  "durations": np.where(emittedKinds == EVENT_NOTE, values[emittedIndex], 0)}
+  if(options.bUniqueTracks):
+    # Tracks are given out in note order
+    emittedNotes = valueB[emittedIndex][emittedKinds == EVENT_NOTE].tolist()
+    tracks = np.zeros(len(emittedIndex), dtype=np.uint8)
+    tracks[emittedKinds == EVENT_NOTE] = [getTrackForNote(context, events, midiSection, note) for note in emittedNotes]
+    eventColumns["tracks"] = tracks
+  else:
+    eventColumns["tracks"] = np.zeros(len(emittedIndex), dtype=np.uint8)
+  events.extend(eventColumns)
+  
+  midiSection.bHasMIDI = True
+  countNumpyEvents(context, cmds[countedStarts])
+  return True
+
+def countNumpyEvents(context, eventCmds):
+  if(context.profile != None):
+    for midiCmd, eventCount in enumerate(np.bincount(eventCmds, minlength=256).tolist()):
+      context.profile.opcodeCounts[midiCmd] += eventCount
+
+def readProjectHeader(context, decodedData):
+  if bDebug: dumpbytes(decodedData, 0, 0x800)
+  
+  # Pull out the tempo, offset is number of BITS
+  preciseBPM = int.from_bytes(decodedData[TEMPO_OFFSET // 8:TEMPO_OFFSET // 8 + 3], "little")
+  context.songTempo = preciseBPM/10000
+  debugPrint("Tempo BPM is {} ({:#x})", context.songTempo, preciseBPM)
+  
+  # Pull out the time signature 
+  context.numerator = decodedData[TIME_SIGNATURE_OFFSET // 8]
+  context.denominator = decodedData[TIME_SIGNATURE_OFFSET // 8 + 1]
+  debugPrint("Time signature is {}/{}", context.numerator, 2**context.denominator)
+
+def scanRecords(context, decodedData, s = None):
+  # Reads only the record and section headers of the decoded project data without
+  # decoding any events.  Returns a dict of MIDISection keyed by record number and MIDI
+  # ID, and a list of (hash key, section, data start, data length) for each MIDI data
+  # block in the order they appear.  s is the bitstream used by the reference decoder.
+  options = context.options
+  recordHash = dict()
+  midiBlocks = []
+  
+  # Walk the records that we are interested in, in the order they appear in the data
+  startTime = time.perf_counter()
+  recordMarkers = findRecordMarkers(decodedData, RECORD_MARKERS)
+  if(context.profile != None): context.profile.addTime("markerScan", time.perf_counter() - startTime)
+  for recordOffset, recordMarker in recordMarkers:
+    if bDebug:
+      debugPrint("Byte offset {} ({})", recordOffset, recordMarker.decode("ascii"))
+      dumpbytes(decodedData, recordOffset, 64)
+    
+    try:
+      if(options.bReferenceDecoder):
+        recordType, recordSubType, recordNumber, recordMidiID, dataLength, dataStart = readRecordHeaderBits(s, recordOffset)
+      else:
+        recordType, recordSubType, recordNumber, recordMidiID, dataLength, dataStart = readRecordHeader(decodedData, recordOffset)
+    except (struct.error, IndexError) as ex:
+      # The data ends part way through the header
+      if(not options.bRecover):
+        raise
+      addDiagnostic(context, decodedData, recordOffset, "Truncated record header ({})".format(ex))
+      continue
+    
+    if bDebug:
+      debugPrint("Data length is: {} Type is: {} Record no: {} MIDI ID: {}", dataLength, recordType, recordNumber, recordMidiID)
+      if(recordType == 1 or recordType == 5): dumpbytes(decodedData, dataStart, dataLength)
+  
+    # Test for a MIDI block header
+    blockType = decodedData[dataStart:dataStart + 3]
+  
+    if bDebug: debugPrint("BlockType is {}", blockType.hex())
+    
+    # Is this a section header?
+    if(recordType == 2 and
+      (blockType in VALID_BLOCKS)):
+      try:
+        if(options.bReferenceDecoder):
+          associatedMidiID, origSectionName = readSectionHeaderBits(s, dataStart)
+        else:
+          associatedMidiID, origSectionName = readSectionHeader(decodedData, dataStart)
+      except (struct.error, IndexError, UnicodeDecodeError) as ex:
+        if(not options.bRecover):
+          raise
+        addDiagnostic(context, decodedData, dataStart, "Bad section header ({})".format(ex))
+        continue
+      # Create a key from the record + associated midi ID
+      hashKey = createKey(str(recordNumber), str(associatedMidiID))
+      
+      # Strip out filename unfriendly characters
+      sectionName = "".join(thisChar for thisChar in origSectionName if (thisChar.isalnum() or thisChar in "._- "))
+      
+      debugPrint("Section name is {} (orig {}), hash key is {}", sectionName, origSectionName, hashKey)
+        
+      existingRecord = recordHash.get(hashKey)
+      # Validation - The key should be unique
+      if(existingRecord != None):
+        if(not options.bRecover):
+          raise ExtractError("ERROR: Found second record for key {}".format(hashKey))
+        addDiagnostic(context, decodedData, recordOffset, "Found second record for key {}".format(hashKey))
+        continue
+  
+      midiSection = MIDISection(sectionName, associatedMidiID, recordNumber)
+      recordHash[hashKey] = midiSection
+    elif(recordType == 1): # MIDI data block
+      hashKey = createKey(str(recordNumber), str(recordMidiID))    
+      debugPrint("Hash key is {}", hashKey)
+      # Have we seen a section header with this MIDI ID?
+      midiSection = recordHash.get(hashKey)
+      if(midiSection != None):
+        debugPrint("Found MIDI data for section {}", midiSection.label)
+        midiBlocks.append((hashKey, midiSection, dataStart, dataLength))
+  return recordHash, midiBlocks
+
+def parseRecords(context, decodedData):
+  # Walks the records of the decoded project data and returns a dict of MIDISection,
+  # keyed by record number and MIDI ID, holding the decoded MIDI for each selected section
+  
+  # The reference decoder parses a bitstream of the decoded data
+  s = None
+  if(context.options.bReferenceDecoder):
+    from bitstring import ConstBitStream
+    s = ConstBitStream(bytes=bytes(decodedData))
+  
+  readProjectHeader(context, decodedData)
+  recordHash, midiBlocks = scanRecords(context, decodedData, s)
+  
+  if(context.sectionFilter != None):
+    selectedHash = dict()
+    selectedBlocks = []
+    for hashKey, midiSection in recordHash.items():
+      if(isSectionSelected(context.sectionFilter, midiSection)):
+        selectedHash[hashKey] = midiSection
+      elif(context.previousManifest != None and hashKey in context.previousManifest):
+        # Keep what was written for this section by an earlier run
+        context.manifest[hashKey] = context.previousManifest[hashKey]
+    for midiBlock in midiBlocks:
+      if(midiBlock[0] in selectedHash):
+        selectedBlocks.append(midiBlock)
+    debugPrint("Selected {} of {} sections", len(selectedHash), len(recordHash))
+    recordHash, midiBlocks = selectedHash, selectedBlocks
+  
+  # Each MIDI data block can now be decoded on its own, except that with no base time
+  # set the blocks must be decoded in order until the first note has been found
+  bParallel = (context.decodeJobs > 1 and len(midiBlocks) > 1 and
+               sum(midiBlock[3] for midiBlock in midiBlocks) >= context.parallelDecodeThreshold)
+  decodedSections = []
+  parallelBlocks = []
+  context.sectionCount = len(midiBlocks)
+  
+  # Sections with byte for byte identical data blocks, e.g. copied regions, are only
+  # decoded once
+  payloadSections = dict()
+  if(context.options.identicalSections != None):
+    for hashKey, midiSection, dataStart, dataLength in midiBlocks:
+      payloadDigest = hashlib.sha256(memoryview(decodedData)[dataStart:dataStart + dataLength]).digest()
+      payloadSections.setdefault(payloadDigest, []).append(midiSection)
+    payloadSections = {id(midiSection): sameSections for sameSections in payloadSections.values() for midiSection in sameSections}
+  
+  for hashKey, midiSection, dataStart, dataLength in midiBlocks:
+    manifestEntry = None
+    if(id(midiSection) in context.identicalTo):
+      # Written along with the section it is identical to
+      if(context.previousManifest != None):
+        manifestEntry = {"digest": getSectionDigest(context, midiSection, memoryview(decodedData)[dataStart:dataStart + dataLength]),
+                         "filename": None, "baseTime": context.baseTime}
+        context.manifest[hashKey] = manifestEntry
+      decodedSections.append((midiSection, manifestEntry))
+      context.sectionCount -= 1
+      continue
+    if(context.previousManifest != None):
+      sectionDigest = getSectionDigest(context, midiSection, memoryview(decodedData)[dataStart:dataStart + dataLength])
+      cachedSection = context.previousManifest.get(hashKey)
+      if(cachedSection != None and cachedSection["digest"] == sectionDigest and
+         (cachedSection["filename"] == None or os.path.exists(os.path.join(context.outputDir, cachedSection["filename"])))):
+        debugPrint("Section {} is unchanged", midiSection.label)
+        midiSection.bUnchanged = True
+        midiSection.bHasMIDI = (cachedSection["filename"] != None)
+        # Later sections may depend on the base time found in this one
+        context.baseTime = cachedSection["baseTime"]
+        context.manifest[hashKey] = cachedSection
+        context.sectionCount -= 1
+        continue
+      manifestEntry = {"digest": sectionDigest, "filename": None, "baseTime": context.baseTime}
+      context.manifest[hashKey] = manifestEntry
+    
+    sameSections = payloadSections.get(id(midiSection), [])
+    if(len(sameSections) > 1):
+      identicalSections = sameSections[sameSections.index(midiSection) + 1:]
+      context.identicalSections[id(midiSection)] = identicalSections
+      for identicalSection in identicalSections:
+        context.identicalTo[id(identicalSection)] = midiSection
+    
+    if(bParallel and context.baseTime != None):
+      parallelBlocks.append((midiSection, dataStart, dataLength, getCopiedSections(context, midiSection)))
+    else:
+      midiSection.midiData = decodeSection(context, decodedData, midiSection, dataStart, dataLength, s,
+                                           getCopiedSections(context, midiSection))
+      if(manifestEntry != None):
+        manifestEntry["baseTime"] = context.baseTime
+      finishSection(context, midiSection)
+    decodedSections.append((midiSection, manifestEntry))
+  
+  if(len(parallelBlocks) > 0):
+    decodeSectionsInParallel(context, decodedData, parallelBlocks)
+  
+  for midiSection, manifestEntry in decodedSections:
+    if(manifestEntry != None and midiSection.bHasMIDI):
+      manifestEntry["filename"] = getMidiFilename(midiSection)
+  
+  return recordHash
+
+def finishSection(context, midiSection):
+  # Hands the MIDI of a section that has just been decoded to the section writer, when
+  # streaming, along with that of any sections with identical data, and reports progress
+  identicalSections = context.identicalSections.pop(id(midiSection), [])
+  for identicalSection in identicalSections:
+    identicalSection.bHasMIDI = midiSection.bHasMIDI
+    if(context.options.identicalSections == "alias"):
+      continue
+    if(context.bLinkIdentical and midiSection.midiData != None):
+      # Linked once the MIDI file of this section has been written
+      context.sectionWriter.link(getMidiFilename(identicalSection), getMidiFilename(midiSection))
+      identicalSection.bWritten = True
+    # Encoded with its own names along with this section, see encodeIdenticalSections()
+    writeSectionData(context, identicalSection)
+  writeSectionData(context, midiSection)
+  
+  context.sectionsDone += 1
+  if(context.options.progressCallback != None):
+    context.options.progressCallback(context.sectionsDone, context.sectionCount, midiSection.label)
+
+def isLinkingIdentical(context):
+  # Sections identical to another are hard linked to its MIDI file if the files are
+  # written separately, otherwise they are written as copies of their own.  Decode workers
+  # have no section writer so this is kept in context.bLinkIdentical.
+  return (context.options.identicalSections == "link" and context.sectionWriter != None and
+          context.sectionWriter.outputFormat in ("files", "none"))
+
+def getCopiedSections(context, midiSection):
+  # Returns the sections identical to midiSection which are encoded along with it
+  if(context.options.identicalSections == "alias"):
+    return []
+  return context.identicalSections.get(id(midiSection), [])
+
+def writeSectionData(context, midiSection):
+  if(context.sectionWriter != None and midiSection.midiData != None):
+    context.sectionWriter.write(midiSection, midiSection.midiData)
+    midiSection.midiData = None
+    midiSection.bWritten = True
+  if(context.sectionWriter != None and midiSection.analysisData != None):
+    context.sectionWriter.writeFile(getAnalysisFilename(midiSection, context.options.analysisFormat), midiSection.analysisData)
+    midiSection.analysisData = None
+    midiSection.bAnalysisWritten = True
+
+def decodeSection(context, decodedData, midiSection, dataStart, dataLength, s = None, copiedSections = ()):
+  # Decodes one MIDI data block and returns it as the bytes of a MIDI file, or None if
+  # the block has no MIDI or options.outputFormat is "none".  The analysis export of the
+  # section, if any, is left in midiSection.analysisData.  s is the bitstream used by the
+  # reference decoder.  copiedSections are sections with identical data, see
+  # encodeIdenticalSections().
+  events = decodeSectionEvents(context, decodedData, midiSection, dataStart, dataLength, s)
+  midiData = encodeSection(context, midiSection, events)
+  encodeIdenticalSections(context, midiSection, events, copiedSections)
+  return midiData
+
+def encodeIdenticalSections(context, midiSection, events, copiedSections):
+  # Sections with data identical to midiSection have the same events, which only need to
+  # be decoded once, but are encoded again so that their MIDI track names and analysis
+  # export are their own.  The MIDI and analysis export of each is left in the section.
+  # When linking only the analysis export is encoded, as every event in it names its
+  # section.
+  for copiedSection in copiedSections:
+    copiedSection.bHasMIDI = midiSection.bHasMIDI
+    if(context.bLinkIdentical):
+      encodeSectionAnalysis(context, copiedSection, events)
+      continue
+    events.trackNames = [(track, getTrackName(context.options, copiedSection, note)) for note, track in context.trackDict.items()]
+    copiedSection.midiData = encodeSectionData(context, copiedSection, events)
+
+def decodeSectionEvents(context, decodedData, midiSection, dataStart, dataLength, s = None):
+  # Decodes one MIDI data block into an EventStore, which is empty if the block could not
+  # be decoded in recovery mode
+  options = context.options
+  
+  events = EventStore()
+  context.trackCounter = 0
+  context.trackDict = dict()
+  
+  startTime = time.perf_counter()
+  blockBaseTime = context.baseTime
+  try:
+    if(options.bReferenceDecoder):
+      decodeMidiBlockBits(context, s, dataStart, dataLength, midiSection, events)
+    elif(not (context.bNumpyDecoder and
+              decodeMidiBlockNumpy(context, decodedData, dataStart, dataLength, midiSection, events))):
+      decodeMidiBlock(context, decodedData, dataStart, dataLength, midiSection, events)
+  except (ExtractError, struct.error, IndexError) as ex:
+    if(not options.bRecover):
+      raise
+    # Only this block is abandoned.  The next block is found from its own record marker so
+    # nothing after the bad data is lost.
+    if(isinstance(ex, BlockDecodeError)):
+      errorOffset, errorCmd = ex.offset, ex.midiCmd
+    elif(s != None):
+      errorOffset, errorCmd = min(s.pos // 8, len(decodedData) - 1), None
+    else:
+      errorOffset, errorCmd = dataStart, None
+    addDiagnostic(context, decodedData, errorOffset, str(ex) or type(ex).__name__, midiSection, errorCmd)
+    events = EventStore()
+    midiSection.bHasMIDI = False
+    context.baseTime = blockBaseTime
+  if(context.profile != None):
+    context.profile.addTime("blockDecode", time.perf_counter() - startTime)
+    context.profile.sectionCount += 1
+  return events
+
+def encodeSection(context, midiSection, events):
+  # Returns the decoded events of a section as the bytes of a MIDI file, after removing
+  # duplicates and thinning them if asked to, or None as for decodeSection()
+  options = context.options
+  if(not midiSection.bHasMIDI):
+    return None
+  if(options.duplicatePolicy != None):
+    startTime = time.perf_counter()
+    removedCount = events.removeDuplicates(options.duplicatePolicy, options.bDuplicateDuration)
+    debugPrint("Removed {} duplicate events", removedCount)
+    if(context.profile != None): context.profile.addTime("removeDuplicates", time.perf_counter() - startTime)
+  if(options.bThinControllers):
+    startTime = time.perf_counter()
+    controllerCount = len(events) - events.kinds.count(EVENT_NOTE)
+    removedCount = events.thinControllers(options.thinValueTolerance, options.thinTimeTolerance)
+    context.thinnedCounts[0] += controllerCount
+    context.thinnedCounts[1] += controllerCount - removedCount
+    debugPrint("Thinned {} of {} controller events", removedCount, controllerCount)
+    if(context.profile != None): context.profile.addTime("thinControllers", time.perf_counter() - startTime)
+  return encodeSectionData(context, midiSection, events)
+
+def encodeSectionData(context, midiSection, events):
+  # Returns the events of a section, with duplicates already removed and thinned, as the
+  # bytes of a MIDI file, and leaves its analysis export in midiSection.analysisData
+  options = context.options
+  if(not midiSection.bHasMIDI):
+    return None
+  encodeSectionAnalysis(context, midiSection, events)
+  if(options.outputFormat == "none"):
+    return None
+  startTime = time.perf_counter()
+  # Create a new MIDI file object to store the notes for this MIDI section
+  # The writers need not look for duplicates if they have already been removed
+  bRemoveDuplicates = (options.duplicatePolicy == None)
+  # With no track limit there is a track for each note that was given one
+  trackCount = options.trackLimit if options.trackLimit != None else max(1, len(context.trackDict))
+  if(context.bMidiUtilWriter):
+    midiFileData = MIDIFile(numTracks=trackCount, removeDuplicates=bRemoveDuplicates, ticks_per_quarternote=960, eventtime_is_ticks=True)
+  else:
+    midiFileData = SMFWriter(trackCount, 960, removeDuplicates=bRemoveDuplicates)
+  midiFileData.addTimeSignature(0, 0, context.numerator, context.denominator, clocks_per_tick = 24, notes_per_quarter=8)
+  midiFileData.addTempo(0, 0, context.songTempo)
+  midiFileData.addTrackName(0, 0, midiSection.label + "-" + str(midiSection.recordNumber) + "_" + str(midiSection.associatedMidiID))
+  events.writeTo(midiFileData)
+  midiData = getMidiBytes(midiFileData)
+  if(context.profile != None): context.profile.addTime("midiEncode", time.perf_counter() - startTime)
+  return midiData
+
+def encodeSectionAnalysis(context, midiSection, events):
+  # Leaves the analysis export of a section in midiSection.analysisData, if one is wanted
+  if(midiSection.bHasMIDI and context.options.analysisFormat != None):
+    startTime = time.perf_counter()
+    midiSection.analysisData = encodeAnalysisData(context, midiSection, events)
+    if(context.profile != None): context.profile.addTime("analysisEncode", time.perf_counter() - startTime)
+
+def addDiagnostic(context, buf, offset, message, midiSection = None, midiCmd = None):
+  # Records an error stepped over by recovery mode, with a dump of the data leading up to
+  # and including the event where it was found.  buf and offset are None for an error
+  # found rendering an EventCache, which has no project data to dump.
+  dumpStart = None
+  dump = []
+  if(buf != None):
+    dumpStart = max(0, offset - DIAGNOSTIC_DUMP_BEFORE)
+    dumpLength = max(0, min(len(buf), offset + DIAGNOSTIC_DUMP_AFTER) - dumpStart)
+    dump = formatBytes(buf, dumpStart, dumpLength).splitlines()
+  diagnostic = {"offset": offset,
+                "opcode": "0x{:02X}".format(midiCmd) if midiCmd != None else None,
+                "error": message,
+                "section": midiSection.label if midiSection != None else None,
+                "recordNumber": midiSection.recordNumber if midiSection != None else None,
+                "associatedMidiID": midiSection.associatedMidiID if midiSection != None else None,
+                "dumpOffset": dumpStart,
+                "dump": dump}
+  context.diagnostics.append(diagnostic)
+  print("WARN: {}{}{}, skipping to the next {}".format(
+        message, " at offset {:#x}".format(offset) if offset != None else "",
+        " in section " + midiSection.label if midiSection != None else "", "record" if buf != None else "section"))
+
+def encodeAnalysisData(context, midiSection, events):
+  # Returns the decoded events of a section as the bytes of a .npz of one array per
+  # column, or of JSON Lines with one object per event, for analysis without reading the
+  # MIDI back.  Every event carries its section and the project tempo and time signature.
+  if(context.options.analysisFormat == "npz"):
+    analysisFile = io.BytesIO()
+    np.savez(analysisFile,
+             section = np.array(midiSection.label),
+             recordNumber = np.array(midiSection.recordNumber, dtype=np.uint32),
+             associatedMidiID = np.array(midiSection.associatedMidiID, dtype=np.uint32),
+             tempo = np.array(context.songTempo),
+             numerator = np.array(context.numerator, dtype=np.uint8),
+             denominator = np.array(2**context.denominator, dtype=np.uint16),
+             typeNames = np.array(EVENT_FAMILY_NAMES),
+             tick = np.frombuffer(events.times, dtype=np.int64),
+             channel = np.frombuffer(events.channels, dtype=np.uint8),
+             type = np.frombuffer(events.kinds, dtype=np.uint8),
+             data1 = np.frombuffer(events.data1, dtype=np.uint8),
+             data2 = np.frombuffer(events.data2, dtype=np.int16),
+             duration = np.frombuffer(events.durations, dtype=np.uint32),
+             track = np.frombuffer(events.tracks, dtype=np.uint8))
+    return analysisFile.getvalue()
+  
+  # The fields that are the same for every event of the section are only encoded once
+  sectionFields = json.dumps({"section": midiSection.label, "recordNumber": midiSection.recordNumber,
+                              "associatedMidiID": midiSection.associatedMidiID, "tempo": context.songTempo,
+                              "numerator": context.numerator, "denominator": 2**context.denominator})
+  eventFormat = (sectionFields[:-1].replace("{", "{{").replace("}", "}}") +
+                 ', "tick": {}, "channel": {}, "type": "{}", "data1": {}, "data2": {}, "duration": {}, "track": {}}}\n')
+  formatEvent = eventFormat.format
+  return "".join(map(formatEvent, events.times, events.channels, [EVENT_FAMILY_NAMES[kind] for kind in events.kinds],
+                     events.data1, events.data2, events.durations, events.tracks)).encode("utf-8")
+
+def decodeSectionsInParallel(context, decodedData, parallelBlocks):
+  # Decodes the MIDI data blocks on a pool of context.decodeJobs processes.  The decoded
+  # data is copied once into shared memory which the workers read from, so only the
+  # block extents are sent to them and only the MIDI file bytes are sent back.
+  import concurrent.futures
+  startTime = time.perf_counter()
+  sharedData = shared_memory.SharedMemory(create = True, size = max(len(decodedData), 1))
+  try:
+    sharedData.buf[:len(decodedData)] = decodedData
+    contextState = (context.baseTime, context.songTempo, context.numerator, context.denominator, context.bLinkIdentical)
+    with concurrent.futures.ProcessPoolExecutor(max_workers = context.decodeJobs, initializer = initDecodeWorker,
+                                                initargs = (sharedData.name, len(decodedData), context.options, contextState)) as executor:
+      # Longest blocks first so that one long take is not left until last
+      futureBlocks = {executor.submit(decodeSectionWorker, midiSection, dataStart, dataLength, copiedSections): (midiSection, copiedSections)
+                      for midiSection, dataStart, dataLength, copiedSections in sorted(parallelBlocks, key = lambda block: -block[2])}
+      # Each section is written as soon as it is back so that only the sections still
+      # being decoded are held in memory
+      for future in concurrent.futures.as_completed(futureBlocks):
+        midiSection, copiedSections = futureBlocks[future]
+        midiSection.midiData, midiSection.bHasMIDI, midiSection.analysisData, copiedData, sectionDiagnostics, thinnedCounts, sectionProfile = future.result()
+        for copiedSection, (copiedMidiData, copiedAnalysisData) in zip(copiedSections, copiedData):
+          copiedSection.midiData = copiedMidiData
+          copiedSection.analysisData = copiedAnalysisData
+          copiedSection.bHasMIDI = midiSection.bHasMIDI
+        context.diagnostics += sectionDiagnostics
+        context.thinnedCounts[0] += thinnedCounts[0]
+        context.thinnedCounts[1] += thinnedCounts[1]
+        if(sectionProfile != None):
+          context.profile.merge(sectionProfile)
+        finishSection(context, midiSection)
+  finally:
+    sharedData.close()
+    sharedData.unlink()
+  if(context.profile != None): context.profile.addTime("parallelDecode", time.perf_counter() - startTime)
+
+def initDecodeWorker(sharedDataName, dataLength, options, contextState):
+  # Runs once in each decode worker process
+  global decodeWorkerData, decodeWorkerBuffer, decodeWorkerContext
+  # Started workers do not share the modules loaded by the main process
+  loadSharedMemory()
+  decodeWorkerData = shared_memory.SharedMemory(name = sharedDataName)
+  decodeWorkerBuffer = decodeWorkerData.buf[:dataLength]
+  decodeWorkerContext = ExtractContext(options)
+  (decodeWorkerContext.baseTime, decodeWorkerContext.songTempo, decodeWorkerContext.numerator, decodeWorkerContext.denominator,
+   decodeWorkerContext.bLinkIdentical) = contextState
+
+def decodeSectionWorker(midiSection, dataStart, dataLength, copiedSections):
+  # Returns the MIDI file bytes, bHasMIDI, the analysis export, the MIDI file bytes and
+  # analysis export of each of copiedSections, any diagnostics and the counts of thinned
+  # controller events as the sections themselves stay in the main process, along with the
+  # profile of this section if profiling
+  if(decodeWorkerContext.profile != None):
+    decodeWorkerContext.profile = ExtractProfile()
+  decodeWorkerContext.diagnostics = []
+  decodeWorkerContext.thinnedCounts = [0, 0]
+  midiData = decodeSection(decodeWorkerContext, decodeWorkerBuffer, midiSection, dataStart, dataLength, None, copiedSections)
+  return (midiData, midiSection.bHasMIDI, midiSection.analysisData,
+          [(copiedSection.midiData, copiedSection.analysisData) for copiedSection in copiedSections], decodeWorkerContext.diagnostics,
+          decodeWorkerContext.thinnedCounts, decodeWorkerContext.profile)
+
+def readProjectData(pathToGBFile, profile = None):
+  # Decode the base64 data in the projectData file
+  if not os.path.exists(pathToGBFile):
+    raise ExtractError("ERROR: File does not exist: {}".format(pathToGBFile))
+  
+  try:
+    decodedData = loadProjectData(pathToGBFile, profile)
+  except Exception as ex:
+    raise ExtractError("ERROR: Failed to decode data ({})".format(ex))
+  
+  if(decodedData == None):
+    raise ExtractError("ERROR: No NS.data found in {}".format(pathToGBFile))
+  return decodedData
+
+def estimateEventCount(decodedData, dataStart, dataLength):
+  # Every event starts on a 16 byte row so the first byte of each row is a command, except
+  # for the second row of notes and smart drum events.  This over counts if the second row
+  # of a smart drum event happens to start with 0x7x.
+  commandBytes = bytes(decodedData[dataStart:dataStart + dataLength:EVENT_SIZE])
+  secondRows = sum(commandBytes.count(midiCmd) for midiCmd in range(0x70, 0x80)) + \
+               sum(commandBytes.count(midiCmd) for midiCmd in range(0x90, 0xA0))
+  # Less the command that ends the block
+  return max(len(commandBytes) - secondRows - 1, 0)
+
+def listProject(projectPath, options = None):
+  # Returns the table of contents of a GB project, as a list of dicts with the label,
+  # record number, MIDI ID, offset and length of the MIDI data block and an estimate of
+  # the number of events in each section, without decoding any events
+  if(options == None):
+    options = ExtractOptions()
+  context = ExtractContext(options)
+  decodedData = readProjectData(os.path.join(projectPath, "projectData"))
+  readProjectHeader(context, decodedData)
+  recordHash, midiBlocks = scanRecords(context, decodedData)
+  
+  sections = []
+  for hashKey, midiSection, dataStart, dataLength in midiBlocks:
+    sections.append({"label": midiSection.label,
+                     "recordNumber": midiSection.recordNumber,
+                     "associatedMidiID": midiSection.associatedMidiID,
+                     "offset": dataStart,
+                     "dataLength": dataLength,
+                     "estimatedEvents": estimateEventCount(decodedData, dataStart, dataLength),
+                     "selected": isSectionSelected(context.sectionFilter, midiSection)})
+  return sections
+
+def extractProject(projectPath, options = None):
+  # Extracts the MIDI sections of a GB project.band directory to one MIDI file per
+  # section in options.outputDir and returns an ExtractResult.  Raises ExtractError if
+  # the project cannot be extracted.
+  if(options == None):
+    options = ExtractOptions()
+  if(options.profileNames):
+    return extractProfiles(projectPath, options)
+  context = ExtractContext(options)
+  extractStartTime = time.perf_counter()
+  
+  outputDir = options.outputDir
+  if(outputDir == None):
+    if(options.bIncremental):
+      outputDir = getStableOutputDir(projectPath)
+    else:
+      outputDir = "GB_Extract_" + time.strftime("%Y%m%d-%H%M%S")
+  context.outputDir = outputDir
+  result = ExtractResult(projectPath, outputDir)
+  
+  pathToGBFile = os.path.join(projectPath, "projectData")
+  if not os.path.exists(pathToGBFile):
+    raise ExtractError("ERROR: File does not exist: {}".format(pathToGBFile))
+  
+  try:
+    os.makedirs(outputDir, exist_ok = True)
+  except OSError:
+    raise ExtractError("ERROR: Could not create working directory {}".format(outputDir))
+  
+  decodedData = readProjectData(pathToGBFile, context.profile)
+  
+  if(options.bWriteDecodedData):
+    with open(os.path.join(outputDir, "decoded.bin"), "wb") as fp:
+      fp.write(decodedData)
+  
+  if(options.bIncremental):
+    context.previousManifest = readManifest(outputDir)
+  
+  context.sectionWriter = SectionWriter(outputDir, options.outputFormat, getProjectName(projectPath),
+                                       options.writeJobs, context.profile)
+  context.bLinkIdentical = isLinkingIdentical(context)
+  try:
+    recordHash = parseRecords(context, decodedData)
+  except:
+    context.sectionWriter.abort()
+    raise
+  context.sectionWriter.close(list(recordHash.values()))
+  result.archiveFile = context.sectionWriter.archivePath
+  result.songTempo = context.songTempo
+  result.timeSignature = "{}/{}".format(context.numerator, 2**context.denominator)
+  result.diagnostics = sorted(context.diagnostics, key = lambda diagnostic: diagnostic["offset"])
+  result.failedSections = len([diagnostic for diagnostic in context.diagnostics if diagnostic["section"] != None])
+  result.controllerEvents, result.thinnedControllerEvents = context.thinnedCounts
+  
+  # The MIDI files have already been written as each section was decoded
+  for k,v in recordHash.items():
+    debugPrint("Key {} with value {} ", k, v.label)
+    result.sectionLabels.append(v.label)
+    if(v.bUnchanged):
+      if(v.bHasMIDI):
+        result.unchangedFiles.append(getMidiFilename(v))
+    elif(v.bWritten):
+      result.midiFiles.append(getMidiFilename(v))
+    if(v.bAnalysisWritten):
+      result.analysisFiles.append(getAnalysisFilename(v, options.analysisFormat))
+    if(options.identicalSections == "alias" and v.bHasMIDI and id(v) in context.identicalTo):
+      result.aliases[getMidiFilename(v)] = getMidiFilename(context.identicalTo[id(v)])
+  
+  if(len(result.aliases) > 0):
+    with open(os.path.join(outputDir, ALIASES_FILENAME), "w") as aliasesFile:
+      json.dump(result.aliases, aliasesFile, indent = 2)
+  
+  if(options.bIncremental):
+    # Remove MIDI files left by sections which have since been deleted or renamed
+    currentFiles = set(manifestEntry["filename"] for manifestEntry in context.manifest.values())
+    for cachedSection in context.previousManifest.values():
+      staleFile = cachedSection["filename"]
+      if(staleFile != None and staleFile not in currentFiles and
+         os.path.exists(os.path.join(outputDir, staleFile))):
+        debugPrint("Removing {}", staleFile)
+        os.remove(os.path.join(outputDir, staleFile))
+    writeManifest(outputDir, context.manifest)
+  
+  if(bDumpFile):
+    fileSize = len(decodedData)
+    debugPrint("fileSize is {}", fileSize)
+    dumpbytes(decodedData, 0, fileSize)
+  
+  if(context.profile != None):
+    context.profile.addTime("total", time.perf_counter() - extractStartTime)
+    result.profile = context.profile.toReport()
+  return result
+
+def extractProfiles(projectPath, options):
+  # Extracts a GB project once for each of options.profileNames, each to a directory of
+  # its own named after the profile.  The project is only decoded once, to an EventCache
+  # kept in the output directory which later runs use again until the project is saved.
+  extractStartTime = time.perf_counter()
+  profileContexts = []
+  for profileName in options.profileNames:
+    profileOverrides = options.renderProfiles.get(profileName)
+    if(profileOverrides == None):
+      raise ExtractError("ERROR: Unknown render profile {}, expected one of {}".format(profileName, ", ".join(options.renderProfiles)))
+    profileOptions = copy.copy(options)
+    profileOptions.profileNames = None
+    for optionName, optionValue in profileOverrides.items():
+      if(not hasattr(profileOptions, optionName) or optionName in ("outputDir", "renderProfiles", "profileNames")):
+        raise ExtractError("ERROR: Unknown option {} in render profile {}".format(optionName, profileName))
+      setattr(profileOptions, optionName, optionValue)
+    if(profileOptions.bIncremental):
+      raise ExtractError("ERROR: Incremental extraction cannot write render profiles")
+    profileContexts.append((profileName, ExtractContext(profileOptions)))
+  
+  outputDir = options.outputDir
+  if(outputDir == None):
+    outputDir = "GB_Extract_" + time.strftime("%Y%m%d-%H%M%S")
+  result = ExtractResult(projectPath, outputDir)
+  
+  pathToGBFile = os.path.join(projectPath, "projectData")
+  if not os.path.exists(pathToGBFile):
+    raise ExtractError("ERROR: File does not exist: {}".format(pathToGBFile))
+  
+  try:
+    os.makedirs(outputDir, exist_ok = True)
+  except OSError:
+    raise ExtractError("ERROR: Could not create working directory {}".format(outputDir))
+  
+  # Every profile adds to the same profile of the extraction
+  profile = ExtractProfile() if options.bProfile else None
+  startTime = time.perf_counter()
+  cachePath = os.path.join(outputDir, EVENT_CACHE_FILENAME)
+  fileSignature = getFileSignature(pathToGBFile)
+  eventCache = loadEventCache(cachePath, fileSignature, options.bRecover)
+  if(eventCache == None):
+    header, columns = buildEventCache(pathToGBFile, fileSignature, options, profile)
+    try:
+      writeEventCache(cachePath, header, columns)
+    except OSError as ex:
+      raise ExtractError("ERROR: Could not write {} ({})".format(cachePath, ex))
+    eventCache = loadEventCache(cachePath, fileSignature, options.bRecover)
+    if(eventCache == None):
+      raise ExtractError("ERROR: Could not read {}".format(cachePath))
+  else:
+    debugPrint("Using the events cached in {}", cachePath)
+  if(profile != None): profile.addTime("eventCache", time.perf_counter() - startTime)
+  
+  header = eventCache.header
+  result.songTempo = header["tempo"]
+  result.timeSignature = "{}/{}".format(header["numerator"], 2**header["denominator"])
+  result.sectionLabels = [sectionInfo["label"] for sectionInfo in header["sections"]]
+  result.diagnostics = list(header["diagnostics"])
+  result.failedSections = len([diagnostic for diagnostic in header["diagnostics"] if diagnostic["section"] != None])
+  try:
+    for profileName, context in profileContexts:
+      context.profile = profile
+      profileResult = renderProfile(context, eventCache, projectPath, os.path.join(outputDir, profileName))
+      result.profiles[profileName] = profileResult
+      result.midiFiles += [profileName + "/" + filename for filename in profileResult.midiFiles]
+      result.analysisFiles += [profileName + "/" + filename for filename in profileResult.analysisFiles]
+      result.aliases.update({profileName + "/" + filename: profileName + "/" + originalFilename
+                             for filename, originalFilename in profileResult.aliases.items()})
+      result.controllerEvents += profileResult.controllerEvents
+      result.thinnedControllerEvents += profileResult.thinnedControllerEvents
+      # Sections which could be decoded but not rendered with the options of this profile
+      result.diagnostics += [dict(diagnostic, profile = profileName) for diagnostic in profileResult.diagnostics]
+      result.failedSections += profileResult.failedSections
+  finally:
+    eventCache.close()
+  
+  if(profile != None):
+    profile.addTime("total", time.perf_counter() - extractStartTime)
+    result.profile = profile.toReport()
+  return result
+
+def buildEventCache(pathToGBFile, fileSignature, options, profile = None):
+  # Decodes every section of a project with none of the options which change its events
+  # applied, so times are ticks from the start of the project, pitch bends are not scaled
+  # and every note is kept on track zero.  Returns the header and columns of an EventCache.
+  # Sections with identical data blocks share the same events, or payload.
+  cacheOptions = copy.copy(options)
+  cacheOptions.baseTime = 0
+  cacheOptions.bOverridePitchBend = False
+  cacheOptions.bUniqueTracks = False
+  cacheOptions.trackLimit = 1
+  cacheOptions.eventClasses = None
+  cacheOptions.duplicatePolicy = None
+  cacheOptions.selectSections = None
+  cacheOptions.identicalSections = None
+  cacheOptions.analysisFormat = None
+  cacheOptions.outputFormat = "files"
+  cacheOptions.bIncremental = False
+  cacheOptions.bProfile = False
+  context = ExtractContext(cacheOptions)
+  context.profile = profile
+  context.bAdjacentNoteWorkaround = False
+  
+  decodedData = readProjectData(pathToGBFile, profile)
+  s = None
+  if(cacheOptions.bReferenceDecoder):
+    from bitstring import ConstBitStream
+    s = ConstBitStream(bytes=bytes(decodedData))
+  readProjectHeader(context, decodedData)
+  recordHash, midiBlocks = scanRecords(context, decodedData, s)
+  
+  columns = {columnName: array(typeCode) for columnName, typeCode in EventCache.COLUMNS}
+  # [first event, event count] of each payload
+  payloads = []
+  payloadIndexes = dict()
+  blockPayloads = dict()
+  for blockIndex, (hashKey, midiSection, dataStart, dataLength) in enumerate(midiBlocks):
+    payloadDigest = hashlib.sha256(memoryview(decodedData)[dataStart:dataStart + dataLength]).digest()
+    payloadIndex = payloadIndexes.get(payloadDigest)
+    if(payloadIndex == None):
+      events = decodeSectionEvents(context, decodedData, midiSection, dataStart, dataLength, s)
+      payloadIndex = len(payloads)
+      payloads.append([len(columns["kinds"]), len(events)])
+      payloadIndexes[payloadDigest] = payloadIndex
+      for columnName, typeCode in EventCache.COLUMNS:
+        columns[columnName].extend(getattr(events, columnName))
+    blockPayloads[id(midiSection)] = (blockIndex, payloadIndex)
+  
+  # block is the order of the data block of each section in the project, as the first
+  # note is looked for in that order when baseTime is None
+  sections = []
+  for hashKey, midiSection in recordHash.items():
+    blockIndex, payloadIndex = blockPayloads.get(id(midiSection), (None, None))
+    sections.append({"label": midiSection.label,
+                     "recordNumber": midiSection.recordNumber,
+                     "associatedMidiID": midiSection.associatedMidiID,
+                     "block": blockIndex,
+                     "payload": payloadIndex})
+  header = {"signature": list(fileSignature),
+            "byteOrder": sys.byteorder,
+            "tempo": context.songTempo,
+            "numerator": context.numerator,
+            "denominator": context.denominator,
+            "sections": sections,
+            "payloads": payloads,
+            "diagnostics": sorted(context.diagnostics, key = lambda diagnostic: diagnostic["offset"])}
+  return header, columns
+
+def writeEventCache(cachePath, header, columns):
+  # Written to a temporary file first, as for the manifest, so that an interrupted run
+  # cannot leave a cache which does not match the project
+  headerData = json.dumps(header).encode("utf-8")
+  with open(cachePath + ".tmp", "wb") as cacheFile:
+    cacheFile.write(EVENT_CACHE_HEADER.pack(EVENT_CACHE_MAGIC, EVENT_CACHE_VERSION, len(headerData), len(columns["kinds"])))
+    cacheFile.write(headerData)
+    for columnName, typeCode in EventCache.COLUMNS:
+      # Each column starts on an 8 byte boundary so that it can be used where it is
+      cacheFile.write(bytes(-cacheFile.tell() % 8))
+      columns[columnName].tofile(cacheFile)
+  os.replace(cachePath + ".tmp", cachePath)
+
+def loadEventCache(cachePath, fileSignature, bRecover):
+  # Returns the EventCache in cachePath if it was built from the projectData with
+  # fileSignature, or None if there is not a usable one.  A cache with errors stepped
+  # over by recovery mode is only used in recovery mode.
+  try:
+    with open(cachePath, "rb") as cacheFile:
+      mappedFile = mmap.mmap(cacheFile.fileno(), 0, access = mmap.ACCESS_READ)
+  except (OSError, ValueError):
+    return None
+  mappedView = memoryview(mappedFile)
+  columns = dict()
+  try:
+    cacheMagic, cacheVersion, headerLength, eventCount = EVENT_CACHE_HEADER.unpack_from(mappedFile, 0)
+    if(cacheMagic != EVENT_CACHE_MAGIC or cacheVersion != EVENT_CACHE_VERSION):
+      raise ValueError("Not an event cache")
+    header = json.loads(mappedFile[EVENT_CACHE_HEADER.size:EVENT_CACHE_HEADER.size + headerLength])
+    if(header["signature"] != list(fileSignature) or header["byteOrder"] != sys.byteorder or
+       (len(header["diagnostics"]) > 0 and not bRecover)):
+      raise ValueError("Out of date")
+    columnStart = EVENT_CACHE_HEADER.size + headerLength
+    for columnName, typeCode in EventCache.COLUMNS:
+      columnStart += -columnStart % 8
+      columnEnd = columnStart + eventCount * array(typeCode).itemsize
+      if(columnEnd > len(mappedFile)):
+        raise ValueError("Truncated")
+      columns[columnName] = mappedView[columnStart:columnEnd].cast(typeCode)
+      columnStart = columnEnd
+  except (struct.error, ValueError, KeyError, TypeError) as ex:
+    debugPrint("Not using {} ({})", cachePath, ex)
+    EventCache(None, columns, mappedFile, mappedView).close()
+    return None
+  return EventCache(header, columns, mappedFile, mappedView)
+
+def renderProfile(context, eventCache, projectPath, profileDir):
+  # Writes the selected sections of an EventCache to profileDir with the options of
+  # context, as extractProject() would have written them, and returns an ExtractResult
+  options = context.options
+  header = eventCache.header
+  context.songTempo = header["tempo"]
+  context.numerator = header["numerator"]
+  context.denominator = header["denominator"]
+  context.outputDir = profileDir
+  result = ExtractResult(projectPath, profileDir)
+  try:
+    os.makedirs(profileDir, exist_ok = True)
+  except OSError:
+    raise ExtractError("ERROR: Could not create working directory {}".format(profileDir))
+  
+  sections = [(MIDISection(sectionInfo["label"], sectionInfo["associatedMidiID"], sectionInfo["recordNumber"]), sectionInfo)
+              for sectionInfo in header["sections"]]
+  renderedSections = sorted([(midiSection, sectionInfo) for midiSection, sectionInfo in sections
+                             if sectionInfo["block"] != None and isSectionSelected(context.sectionFilter, midiSection)],
+                            key = lambda section: section[1]["block"])
+  context.sectionCount = len(renderedSections)
+  if(options.identicalSections != None):
+    # Sections which share a payload had identical data blocks
+    payloadSections = dict()
+    for midiSection, sectionInfo in renderedSections:
+      payloadSections.setdefault(sectionInfo["payload"], []).append(midiSection)
+    for sameSections in payloadSections.values():
+      context.identicalSections[id(sameSections[0])] = sameSections[1:]
+      for identicalSection in sameSections[1:]:
+        context.identicalTo[id(identicalSection)] = sameSections[0]
+  
+  context.sectionWriter = SectionWriter(profileDir, options.outputFormat, getProjectName(projectPath),
+                                       options.writeJobs, context.profile)
+  context.bLinkIdentical = isLinkingIdentical(context)
+  try:
+    for midiSection, sectionInfo in renderedSections:
+      if(id(midiSection) in context.identicalTo):
+        # Written along with the section it is identical to
+        context.sectionCount -= 1
+        continue
+      events = renderSectionEvents(context, midiSection, eventCache.getEvents(sectionInfo["payload"]))
+      midiSection.midiData = encodeSection(context, midiSection, events)
+      encodeIdenticalSections(context, midiSection, events, getCopiedSections(context, midiSection))
+      finishSection(context, midiSection)
+  except:
+    context.sectionWriter.abort()
+    raise
+  context.sectionWriter.close([midiSection for midiSection, sectionInfo in sections])
+  result.archiveFile = context.sectionWriter.archivePath
+  result.controllerEvents, result.thinnedControllerEvents = context.thinnedCounts
+  result.diagnostics = context.diagnostics
+  result.failedSections = len(context.diagnostics)
+  
+  for midiSection, sectionInfo in sections:
+    result.sectionLabels.append(midiSection.label)
+    if(midiSection.bWritten):
+      result.midiFiles.append(getMidiFilename(midiSection))
+    if(midiSection.bAnalysisWritten):
+      result.analysisFiles.append(getAnalysisFilename(midiSection, options.analysisFormat))
+    if(options.identicalSections == "alias" and midiSection.bHasMIDI and id(midiSection) in context.identicalTo):
+      result.aliases[getMidiFilename(midiSection)] = getMidiFilename(context.identicalTo[id(midiSection)])
+  if(len(result.aliases) > 0):
+    with open(os.path.join(profileDir, ALIASES_FILENAME), "w") as aliasesFile:
+      json.dump(result.aliases, aliasesFile, indent = 2)
+  return result
+
+def renderSectionEvents(context, midiSection, columns):
+  # Returns the events of one section from an EventCache with the options of context
+  # applied to them in the same way as the decoders apply them
+  options = context.options
+  events = EventStore()
+  context.trackCounter = 0
+  context.trackDict = dict()
+  startTime = time.perf_counter()
+  
+  # Kinds of the event classes that are wanted
+  wantedKinds = set(context.eventKinds)
+  try:
+    renderSectionEventsInto(context, midiSection, columns, wantedKinds, events)
+  except ExtractError as ex:
+    if(not options.bRecover):
+      raise
+    # As decodeSectionEvents(), only this section is abandoned
+    addDiagnostic(context, None, None, str(ex), midiSection)
+    events = EventStore()
+  midiSection.bHasMIDI = (len(events) > 0)
+  
+  if(context.profile != None):
+    context.profile.addTime("render", time.perf_counter() - startTime)
+    context.profile.sectionCount += 1
+  return events
+
+def renderSectionEventsInto(context, midiSection, columns, wantedKinds, events):
+  # Adds the wanted events of columns to events, see renderSectionEvents()
+  options = context.options
+  if(context.bNumpyDecoder):
+    renderSectionEventsNumpy(context, midiSection, columns, wantedKinds, events)
+  else:
+    lastNote = None
+    for kind, channel, eventTime, data1, data2, duration in zip(columns["kinds"], columns["channels"], columns["times"],
+                                                                columns["data1"], columns["data2"], columns["durations"]):
+      if(kind not in wantedKinds):
+        continue
+      if(kind == EVENT_NOTE):
+        # As addNoteEvent()
+        if(context.bAdjacentNoteWorkaround and lastNote == (data1, eventTime)):
+          continue
+        lastNote = (data1, eventTime)
+        if(context.baseTime == None):
+          context.baseTime = eventTime
+        trackToUse = 0
+        if(options.bUniqueTracks):
+          trackToUse = getTrackForNote(context, events, midiSection, data1)
+        events.add(EVENT_NOTE, channel, eventTime - context.baseTime, data1, data2, duration, trackToUse)
+        continue
+      if(context.baseTime == None):
+        raise ExtractError("ERROR: Section {} has events before its first note, which needs a baseTime".format(midiSection.label))
+      if(kind == EVENT_PITCH_BEND and options.bOverridePitchBend):
+        # As addPitchBendEvent()
+        data2 = min(max(data2 * options.pitchBendMultiplier, -8192), 8191)
+      events.add(kind, channel, eventTime - context.baseTime, data1, data2)
+
+def renderSectionEventsNumpy(context, midiSection, columns, wantedKinds, events):
+  # The same as the loop in renderSectionEventsInto() but with array operations, when the
+  # NumPy decoder is used
+  options = context.options
+  kinds = np.frombuffer(columns["kinds"], dtype=np.uint8)
+  data1 = np.frombuffer(columns["data1"], dtype=np.uint8)
+  eventTimes = np.frombuffer(columns["times"], dtype=np.int64)
+  bKept = np.isin(kinds, list(wantedKinds))
+  bNote = (kinds == EVENT_NOTE)
+  if(context.bAdjacentNoteWorkaround):
+    # As decodeMidiBlockNumpy()
+    noteIndex = np.flatnonzero(bNote)
+    bKept[noteIndex[1:]] &= ~((data1[noteIndex[1:]] == data1[noteIndex[:-1]]) &
+                              (eventTimes[noteIndex[1:]] == eventTimes[noteIndex[:-1]]))
+  keptIndex = np.flatnonzero(bKept)
+  if(len(keptIndex) == 0):
+    return
+  keptKinds = kinds[keptIndex]
+  if(context.baseTime == None):
+    if(keptKinds[0] != EVENT_NOTE):
+      raise ExtractError("ERROR: Section {} has events before its first note, which needs a baseTime".format(midiSection.label))
+    context.baseTime = int(eventTimes[keptIndex[0]])
+  
+  data2 = np.frombuffer(columns["data2"], dtype=np.int16)[keptIndex].astype(np.int64)
+  if(options.bOverridePitchBend):
+    bPitchBend = (keptKinds == EVENT_PITCH_BEND)
+    data2[bPitchBend] = np.clip(data2[bPitchBend] * options.pitchBendMultiplier, -8192, 8191)
+  keptData1 = data1[keptIndex]
+  tracks = np.zeros(len(keptIndex), dtype=np.uint8)
+  if(options.bUniqueTracks):
+    # Tracks are given out in note order
+    bKeptNote = (keptKinds == EVENT_NOTE)
+    tracks[bKeptNote] = [getTrackForNote(context, events, midiSection, note) for note in keptData1[bKeptNote].tolist()]
+  events.extend({"kinds": keptKinds,
+                 "channels": np.frombuffer(columns["channels"], dtype=np.uint8)[keptIndex],
+                 "times": eventTimes[keptIndex] - context.baseTime,
+                 "data1": keptData1,
+                 "data2": data2,
+                 "durations": np.frombuffer(columns["durations"], dtype=np.uint32)[keptIndex],
+                 "tracks": tracks})
+
+def readMidiEvents(midiData):
+  # Reads a Standard MIDI File into a list of tracks, each a list of (tick, event bytes)
+  # with running status expanded, so that files from different writers can be compared
+  midiData = bytes(midiData)
+  if(midiData[0:4] != b"MThd"):
+    raise ExtractError("ERROR: Not a MIDI file")
+  pos = 8 + struct.unpack_from(">L", midiData, 4)[0]
+  tracks = []
+  while(pos < len(midiData)):
+    chunkType = midiData[pos:pos + 4]
+    chunkEnd = pos + 8 + struct.unpack_from(">L", midiData, pos + 4)[0]
+    pos += 8
+    if(chunkType != b"MTrk"):
+      pos = chunkEnd
+      continue
+    trackEvents = []
+    tick = 0
+    runningStatus = None
+    while(pos < chunkEnd):
+      deltaTime, pos = readVarLength(midiData, pos)
+      tick += deltaTime
+      eventStart = pos
+      if(midiData[pos] & 0x80):
+        status = midiData[pos]
+        pos += 1
+      else:
+        status = runningStatus
+      if(status == 0xFF):
+        dataLength, pos = readVarLength(midiData, pos + 1)
+        pos += dataLength
+        runningStatus = None
+      elif(status == 0xF0 or status == 0xF7):
+        dataLength, pos = readVarLength(midiData, pos)
+        pos += dataLength
+        runningStatus = None
+      elif(status == None):
+        raise ExtractError("ERROR: MIDI data byte without a status at {}".format(eventStart))
+      else:
+        dataStart = pos
+        pos += 1 if ((status & 0xF0) == 0xC0 or (status & 0xF0) == 0xD0) else 2
+        runningStatus = status
+        trackEvents.append((tick, bytes([status]) + midiData[dataStart:pos]))
+        continue
+      trackEvents.append((tick, midiData[eventStart:pos]))
+    tracks.append(trackEvents)
+    pos = chunkEnd
+  return tracks
+
+def mergeMidiFiles(midiFiles):
+  # Joins Standard MIDI Files written by decodeSection() into one, keeping the tempo track
+  # of the first, which is the same in all of them, and every other track of each
+  trackChunks = []
+  for fileIndex, midiData in enumerate(midiFiles):
+    midiFormat, trackCount, division = struct.unpack_from(">HHH", midiData, 8)
+    pos = 14
+    for trackIndex in range(trackCount):
+      chunkLength = struct.unpack_from(">I", midiData, pos + 4)[0]
+      if(trackIndex > 0 or fileIndex == 0):
+        trackChunks.append(midiData[pos:pos + 8 + chunkLength])
+      pos += 8 + chunkLength
+  return b"MThd" + struct.pack(">IHHH", 6, 1, len(trackChunks), division) + b"".join(trackChunks)
+
+def readVarLength(midiData, pos):
+  # Returns the value of the MIDI variable length quantity at pos and the position after it
+  value = 0
+  while True:
+    value = (value << 7) | (midiData[pos] & 0x7F)
+    pos += 1
+    if(midiData[pos - 1] < 0x80):
+      return value, pos
+
+def getMidiBytes(midiFileData):
+  midiBytes = io.BytesIO()
+  midiFileData.writeFile(midiBytes)
+  return midiBytes.getvalue()
+
+def decodeProjectSections(decodedData, options, parallelDecodeThreshold = None, **overrides):
+  # Decodes the sections of a project in memory with options changed by overrides and
+  # returns the bytes of each MIDI file by filename
+  decodeOptions = copy.copy(options)
+  for optionName, optionValue in overrides.items():
+    setattr(decodeOptions, optionName, optionValue)
+  context = ExtractContext(decodeOptions)
+  if(parallelDecodeThreshold != None):
+    context.parallelDecodeThreshold = parallelDecodeThreshold
+  return {getMidiFilename(midiSection): midiSection.midiData
+          for midiSection in parseRecords(context, decodedData).values() if midiSection.midiData != None}
+
+def compareDecoders(projectPath, options = None):
+  # Decodes a project with the reference decoder, whose output is taken as the golden
+  # output, and with each faster decoder.  Returns the names of the MIDI files that differ
+  # from the golden output for each decoder.  Nothing is written.
+  if(options == None):
+    options = ExtractOptions()
+  decodedData = readProjectData(os.path.join(projectPath, "projectData"))
+  goldenFiles = decodeProjectSections(decodedData, options, bReferenceDecoder = True)
+  
+  decoderOverrides = {"struct": {"bReferenceDecoder": False, "bNumpyDecoder": False, "decodeJobs": 1}}
+  if(loadNumpy()):
+    decoderOverrides["numpy"] = {"bReferenceDecoder": False, "bNumpyDecoder": True, "decodeJobs": 1}
+  if(not bIsPythonista and loadSharedMemory()):
+    # Decoded in parallel however small the project is
+    decoderOverrides["parallel"] = {"bReferenceDecoder": False, "decodeJobs": max(2, os.cpu_count() or 1),
+                                    "parallelDecodeThreshold": 0}
+  
+  differentFiles = dict()
+  for decoderName, overrides in decoderOverrides.items():
+    decodedFiles = decodeProjectSections(decodedData, options, **overrides)
+    differentFiles[decoderName] = sorted(filename for filename in set(goldenFiles) | set(decodedFiles)
+                                         if goldenFiles.get(filename) != decodedFiles.get(filename))
+  return differentFiles
+
+def compareMidiWriters(projectPath, options = None):
+  # Decodes a project with both the built-in MIDI writer and MIDIUtil and returns the
+  # names of the MIDI files whose events differ.  Nothing is written.
+  if(not loadMidiUtil()):
+    raise ExtractError("ERROR: MIDIUtil must be installed to compare the MIDI writers")
+  if(options == None):
+    options = ExtractOptions()
+  decodedData = readProjectData(os.path.join(projectPath, "projectData"))
+  
+  writerEvents = []
+  for bUseMidiUtil in (False, True):
+    sectionEvents = dict()
+    for filename, midiData in decodeProjectSections(decodedData, options, bMidiUtilWriter = bUseMidiUtil).items():
+      try:
+        sectionEvents[filename] = readMidiEvents(midiData)
+      except (ExtractError, IndexError, struct.error):
+        # MIDIUtil writes a broken file for events before the base time
+        sectionEvents[filename] = "unreadable"
+    writerEvents.append(sectionEvents)
+  
+  nativeEvents, midiUtilEvents = writerEvents
+  return sorted(filename for filename in set(nativeEvents) | set(midiUtilEvents)
+                if nativeEvents.get(filename) != midiUtilEvents.get(filename))
+
+def findBandProjects(rootDir):
+  # Returns the path of every .band project under rootDir.  Projects are directories
+  # but are not searched themselves.
+  if(rootDir.rstrip(os.sep).endswith(".band")):
+    return [rootDir]
+  
+  projectPaths = []
+  for dirPath, dirNames, fileNames in os.walk(rootDir):
+    for dirName in list(dirNames):
+      if(dirName.endswith(".band")):
+        projectPaths.append(os.path.join(dirPath, dirName))
+        dirNames.remove(dirName)
+  return sorted(projectPaths)
+
+def extractProjectForBatch(projectPath, options):
+  # Batch worker.  Any error is recorded in the result rather than raised so that one
+  # bad project does not stop the batch.
+  startTime = time.time()
+  try:
+    result = extractProject(projectPath, options)
+  except Exception as ex:
+    result = ExtractResult(projectPath, options.outputDir)
+    result.error = str(ex)
+  result.elapsed = time.time() - startTime
+  return result
+
+def runBatch(rootDir, outputDir, jobCount, options):
+  # Extracts every project under rootDir using a pool of jobCount processes.  Each
+  # project is written to its own directory under outputDir, along with a JSON summary
+  # of the whole batch.  Returns the list of ExtractResult.
+  batchJobs = []
+  for projectPath in findBandProjects(rootDir):
+    projectName = os.path.relpath(projectPath, rootDir)
+    if(projectName == os.curdir):
+      projectName = os.path.basename(projectPath.rstrip(os.sep))
+    projectOptions = copy.copy(options)
+    projectOptions.outputDir = os.path.join(outputDir, os.path.splitext(projectName)[0])
+    if(jobCount > 1):
+      # The projects are already being extracted in parallel
+      projectOptions.decodeJobs = 1
+    batchJobs.append((projectPath, projectOptions))
+  
+  print("Found {} projects in {}".format(len(batchJobs), rootDir))
+  
+  results = []
+  def reportResult(result):
+    if(result.error == None and len(result.diagnostics) > 0):
+      print("PARTIAL {} ({} MIDI files, {} errors skipped)".format(result.projectPath, len(result.midiFiles), len(result.diagnostics)))
+    elif(result.error == None):
+      print("OK {} ({} MIDI files)".format(result.projectPath, len(result.midiFiles)))
+    else:
+      print("FAILED {}: {}".format(result.projectPath, result.error))
+    results.append(result)
+  
+  if(jobCount <= 1):
+    # Run in this process, e.g. where multiprocessing is not available
+    for projectPath, projectOptions in batchJobs:
+      reportResult(extractProjectForBatch(projectPath, projectOptions))
+  else:
+    import concurrent.futures
+    with concurrent.futures.ProcessPoolExecutor(max_workers = jobCount) as executor:
+      futureJobs = {executor.submit(extractProjectForBatch, *batchJob): batchJob for batchJob in batchJobs}
+      for future in concurrent.futures.as_completed(futureJobs):
+        try:
+          result = future.result()
+        except Exception as ex:
+          # The worker process itself failed
+          projectPath, projectOptions = futureJobs[future]
+          result = ExtractResult(projectPath, projectOptions.outputDir)
+          result.error = "ERROR: Worker failed ({})".format(ex)
+        reportResult(result)
+  
+  results.sort(key = lambda result: result.projectPath)
+  with open(os.path.join(outputDir, "GB_Extract_Summary.json"), "w") as summaryFile:
+    json.dump([result.toSummary() for result in results], summaryFile, indent = 2)
+  return results
+
+def getFileSignature(filePath):
+  # Cheap check for a change to a file, or None if it cannot be read
+  try:
+    fileStat = os.stat(filePath)
+  except OSError:
+    return None
+  return (fileStat.st_mtime_ns, fileStat.st_size)
+
+def readCompleteFileDigest(filePath):
+  # Returns the sha256 of a projectData file, or None if it looks like GB is still writing
+  # it, i.e. it does not end with the closing plist tag or it changes while being read
+  fileSignature = getFileSignature(filePath)
+  fileDigest = hashlib.sha256()
+  try:
+    with open(filePath, "rb") as projectFile:
+      for fileChunk in iter(lambda: projectFile.read(LOAD_CHUNK_SIZE), b""):
+        fileDigest.update(fileChunk)
+      projectFile.seek(max(0, fileSignature[1] - 64))
+      fileTail = projectFile.read()
+  except (OSError, TypeError):
+    return None
+  if(not fileTail.rstrip().endswith(b"</plist>") or getFileSignature(filePath) != fileSignature):
+    return None
+  return fileDigest.hexdigest()
+
+def watchProjects(projectPaths, outputDir, options):
+  # Polls the projectData of each project and extracts it again once it has been saved,
+  # until interrupted.  A change is only extracted once the file has stopped changing for
+  # WATCH_SETTLE_TIME and is complete, so a save in progress is never read.  Each project
+  # is extracted incrementally to the same directory every time so only the sections
+  # that were changed are decoded and written.
+  watchedProjects = []
+  for projectPath in projectPaths:
+    projectOptions = copy.copy(options)
+    if(outputDir == None):
+      projectOptions.outputDir = getStableOutputDir(projectPath)
+    elif(len(projectPaths) > 1):
+      projectOptions.outputDir = os.path.join(outputDir, getProjectName(projectPath))
+    else:
+      projectOptions.outputDir = outputDir
+    projectOptions.bIncremental = (projectOptions.outputFormat == "files" and projectOptions.analysisFormat == None and
+                                   not projectOptions.profileNames)
+    # Signature and digest of the file last extracted, and the signature last seen with the
+    # time it was first seen
+    watchedProjects.append({"path": projectPath, "options": projectOptions,
+                            "extractedDigest": None, "signature": None, "changedTime": 0.0, "bPending": False})
+  
+  print("Watching {} projects, press Ctrl+C to stop".format(len(watchedProjects)))
+  try:
+    while True:
+      for project in watchedProjects:
+        pathToGBFile = os.path.join(project["path"], "projectData")
+        fileSignature = getFileSignature(pathToGBFile)
+        if(fileSignature != project["signature"]):
+          project["signature"] = fileSignature
+          project["changedTime"] = time.monotonic()
+          project["bPending"] = True
+          continue
+        if(not project["bPending"] or fileSignature == None or
+           time.monotonic() - project["changedTime"] < WATCH_SETTLE_TIME):
+          continue
+        
+        fileDigest = readCompleteFileDigest(pathToGBFile)
+        if(fileDigest == None):
+          # Try again once it has settled again
+          project["changedTime"] = time.monotonic()
+          continue
+        project["bPending"] = False
+        if(fileDigest == project["extractedDigest"]):
+          # Touched but not changed
+          continue
+        
+        startTime = time.perf_counter()
+        try:
+          result = extractProject(project["path"], project["options"])
+        except (ExtractError, OSError, struct.error, IndexError, ValueError) as ex:
+          # A malformed save or an output directory that cannot be written to must not stop
+          # the other projects being watched.  The next save is extracted as normal.
+          print("{} {}: {}".format(time.strftime("%H:%M:%S"), project["path"], str(ex) or type(ex).__name__))
+          continue
+        if(readCompleteFileDigest(pathToGBFile) != fileDigest):
+          # Saved again while being extracted
+          project["bPending"] = True
+          project["changedTime"] = time.monotonic()
+        project["extractedDigest"] = fileDigest
+        print("{} {}: {} sections written, {} unchanged, in {:.2f}s".format(
+              time.strftime("%H:%M:%S"), project["path"], len(result.midiFiles), len(result.unchangedFiles),
+              time.perf_counter() - startTime))
+      time.sleep(WATCH_POLL_INTERVAL)
+  except KeyboardInterrupt:
+    print("Stopped watching")
+
+def packRecord(recordMarker, recordType, recordNumber, recordMidiID, recordData):
+  # A record as found in the decoded project data, see readRecordHeader()
+  return recordMarker + RECORD_HEADER.pack(recordType, 0, recordNumber, recordMidiID, len(recordData))[4:] + recordData
+
+def packEventRow(midiCmd, eventTime, valueA, valueB, subCmd = 0):
+  # One 16 byte row of a MIDI data block
+  eventRow = bytearray(TWO_PART_EVENT.pack(eventTime, valueA, valueB))
+  eventRow[0] = midiCmd
+  eventRow[7] = subCmd
+  return bytes(eventRow)
+
+def generateMidiBlock(rng, eventCount):
+  # Events from every command family that the decoders handle, in time order.  The first
+  # event is a note so that the block also works with baseTime = None.
+  blockData = bytearray()
+  eventTime = BASE_TIME + rng.randint(0, 1920)
+  lastNote = None
+  for eventIndex in range(eventCount):
+    eventTime += rng.choice([0, 0, 10, 60, 120, 240, 480])
+    midiChl = rng.randint(0, 15)
+    eventChoice = 0.0 if eventIndex == 0 else rng.random()
+    if(eventChoice < 0.4):
+      if(lastNote != None and rng.random() < 0.02):
+        # GB sometimes saves the same note twice
+        blockData += lastNote
+        continue
+      lastNote = NOTE_PAIR.pack(0x90 | midiChl, eventTime, rng.randint(1, 127), rng.randint(24, 96),
+                                0x80 | midiChl, 0, rng.randint(10, 1920))
+      blockData += lastNote
+    elif(eventChoice < 0.55):
+      blockData += packEventRow(0xB0 | midiChl, eventTime, rng.randint(0, 127), rng.choice([1, 7, 10, 11, 64]))
+    elif(eventChoice < 0.65):
+      pressureValue = rng.randint(0, 127)
+      blockData += packEventRow(0xD0 | midiChl, eventTime, pressureValue, pressureValue)
+    elif(eventChoice < 0.8):
+      blockData += packEventRow(0xE0 | midiChl, eventTime, rng.randint(0, 127), rng.randint(0, 127))
+    elif(eventChoice < 0.85):
+      blockData += packEventRow(rng.choice([0x00, 0x05, 0x0A, 0xFF]), eventTime, 0, 0, rng.choice([0xA7, 0xA8, 0xB5]))
+    elif(eventChoice < 0.9):
+      blockData += packEventRow(rng.choice([0x20, 0x2F, 0x40, 0x50]), eventTime, rng.randint(0, 127), rng.randint(0, 127))
+    elif(eventChoice < 0.95):
+      blockData += packEventRow(rng.choice([0x80, 0xA0, 0xC0]) | midiChl, eventTime, 0, 0)
+    else:
+      # Smart drum events take two rows
+      blockData += packEventRow(0x70 | midiChl, eventTime, 0, 0) + bytes(EVENT_SIZE)
+  blockData += packEventRow(0xF1, 0, 0, 0)
+  return blockData
+
+def generateProjectData(projectPath, sectionCount, eventsPerSection, seed = 1):
+  # Writes a synthetic GB project to projectPath, which is created if needed, with
+  # sectionCount sections of eventsPerSection events each.  The same seed always gives
+  # the same project.  Returns the number of events written.
+  import random
+  rng = random.Random(seed)
+  decodedData = bytearray(0x800)
+  decodedData[TEMPO_OFFSET // 8:TEMPO_OFFSET // 8 + 3] = rng.choice([900000, 1200000, 1285000]).to_bytes(3, "little")
+  decodedData[TIME_SIGNATURE_OFFSET // 8] = rng.choice([3, 4, 7])
+  decodedData[TIME_SIGNATURE_OFFSET // 8 + 1] = rng.choice([2, 3])
+  
+  for sectionIndex in range(sectionCount):
+    recordNumber = 100 + sectionIndex
+    recordMidiID = 5000 + sectionIndex
+    sectionName = "Section {}/{}".format(sectionIndex + 1, rng.choice(["Drums", "Bass", "Keys"])).encode("utf-8")
+    sectionHeader = SECTION_HEADER.pack(VALID_BLOCKS[sectionIndex % len(VALID_BLOCKS)], recordMidiID, len(sectionName)) + sectionName
+    decodedData += packRecord(b"qSvE", 2, recordNumber, recordMidiID, sectionHeader)
+    # A record of another type which must be skipped
+    decodedData += packRecord(b"qSvE", 2, recordNumber + 1000, recordMidiID, b"\x00" * 64)
+    decodedData += packRecord(b"qeSM", 1, recordNumber, recordMidiID, generateMidiBlock(rng, eventsPerSection))
+  
+  os.makedirs(projectPath, exist_ok = True)
+  with open(os.path.join(projectPath, "projectData"), "w") as projectFile:
+    projectFile.write('<?xml version="1.0" encoding="UTF-8"?>\n<plist version="1.0">\n<dict>\n'
+                      '<key>$objects</key>\n<array>\n<dict>\n<key>NS.data</key>\n<data>\n')
+    # Written in lines as GB does
+    for lineStart in range(0, len(decodedData), 51):
+      projectFile.write(base64.b64encode(decodedData[lineStart:lineStart + 51]).decode("ascii") + "\n")
+    projectFile.write('</data>\n</dict>\n</array>\n</dict>\n</plist>\n')
+  return sectionCount * eventsPerSection
+
+def benchmarkProject(projectPath, options):
+  # Extracts projectPath to a temporary directory and returns the timings, peak memory use
+  # and a digest of the MIDI written.  Run in a new process for each project so that the
+  # peak memory use is that of this project alone.
+  import tempfile
+  with tempfile.TemporaryDirectory() as outputDir:
+    benchmarkOptions = copy.copy(options)
+    benchmarkOptions.outputDir = outputDir
+    benchmarkOptions.bProfile = True
+    benchmarkOptions.bIncremental = False
+    startTime = time.perf_counter()
+    result = extractProject(projectPath, benchmarkOptions)
+    elapsed = time.perf_counter() - startTime
+    midiDigest = hashlib.sha256()
+    for filename in sorted(result.midiFiles):
+      with open(os.path.join(outputDir, filename), "rb") as midiFile:
+        midiDigest.update(filename.encode("utf-8") + midiFile.read())
+  
+  peakMemory = None
+  try:
+    # Not available on every platform
+    import resource
+  except ImportError:
+    resource = None
+  if(resource != None):
+    peakMemory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KB, macOS and iOS report bytes
+    if(sys.platform != "darwin"):
+      peakMemory *= 1024
+  eventCount = result.profile["events"]
+  return {"events": eventCount,
+          "seconds": round(elapsed, 4),
+          "eventsPerSecond": round(eventCount / elapsed),
+          "peakMemoryMB": round(peakMemory / 0x100000, 1) if peakMemory != None else None,
+          "midiDigest": midiDigest.hexdigest(),
+          "phases": result.profile["phases"]}
+
+def measureStartupTime(sampleCount = 5):
+  # Returns the best time of sampleCount new interpreters to import this script, and the
+  # names of any of LAZY_MODULES that importing it loaded.  Returns None, None where
+  # another interpreter cannot be started, e.g. Pythonista.
+  if(bIsPythonista):
+    return None, None
+  import subprocess
+  startupCode = ("import sys, time; startTime = time.perf_counter(); import gbextractor; "
+                 "print(time.perf_counter() - startTime); "
+                 "print(' '.join(moduleName for moduleName in {!r} if moduleName in sys.modules))".format(LAZY_MODULES))
+  importTimes = []
+  for sample in range(sampleCount):
+    startupOutput = subprocess.run([sys.executable, "-c", startupCode], cwd = os.path.dirname(os.path.abspath(__file__)),
+                                   capture_output = True, text = True, check = True).stdout.split("\n")
+    importTimes.append(float(startupOutput[0]))
+  return min(importTimes), startupOutput[1].split()
+
+def runBenchmark(benchmarkDir, options):
+  # Generates synthetic projects of each size in BENCHMARK_SIZES in benchmarkDir, unless
+  # already there, and benchmarks the extraction of each.  The decoders are also checked
+  # against the golden output of the reference decoder on the smallest project.  The
+  # results are compared with, then replace, those of the last benchmark in benchmarkDir
+  # so that changes in speed or output show up.  Returns False if any output differs.
+  os.makedirs(benchmarkDir, exist_ok = True)
+  reportPath = os.path.join(benchmarkDir, "GB_Benchmark.json")
+  try:
+    with open(reportPath, "r") as reportFile:
+      lastReport = json.load(reportFile)
+  except (OSError, ValueError):
+    lastReport = dict()
+  
+  report = {"python": sys.version.split()[0], "numpy": loadNumpy(), "sizes": dict()}
+  bSame = True
+  
+  importTime, eagerModules = measureStartupTime()
+  if(importTime != None):
+    report["startup"] = {"importSeconds": round(importTime, 4), "eagerModules": eagerModules}
+    lastImportTime = lastReport.get("startup", dict()).get("importSeconds")
+    comparison = ""
+    if(lastImportTime != None):
+      comparison = " ({:.2f}x last run)".format(lastImportTime / importTime)
+    print("{:>12} {:8.3f}s{}".format("import", importTime, comparison))
+    if(eagerModules):
+      # These must only be imported by the modes that need them
+      print("WARN: importing the script also imported {}".format(", ".join(eagerModules)))
+      bSame = False
+  for sectionCount, eventsPerSection in BENCHMARK_SIZES:
+    sizeName = "{}x{}".format(sectionCount, eventsPerSection)
+    projectPath = os.path.join(benchmarkDir, "Benchmark_{}.band".format(sizeName))
+    if(not os.path.exists(os.path.join(projectPath, "projectData"))):
+      generateProjectData(projectPath, sectionCount, eventsPerSection)
+    
+    if(bIsPythonista):
+      sizeReport = benchmarkProject(projectPath, options)
+    else:
+      import concurrent.futures
+      with concurrent.futures.ProcessPoolExecutor(max_workers = 1) as executor:
+        sizeReport = executor.submit(benchmarkProject, projectPath, options).result()
+    report["sizes"][sizeName] = sizeReport
+    
+    lastSizeReport = lastReport.get("sizes", dict()).get(sizeName)
+    comparison = ""
+    if(lastSizeReport != None):
+      comparison = " ({:.2f}x last run)".format(lastSizeReport["seconds"] / sizeReport["seconds"])
+      if(lastSizeReport["midiDigest"] != sizeReport["midiDigest"]):
+        print("WARN: MIDI output for {} has changed since the last benchmark".format(sizeName))
+        bSame = False
+    print("{:>12} {:>9} events {:8.3f}s {:>10} events/s {:>8} MB peak{}".format(
+          sizeName, sizeReport["events"], sizeReport["seconds"], sizeReport["eventsPerSecond"],
+          sizeReport["peakMemoryMB"], comparison))
+  
+  sectionCount, eventsPerSection = BENCHMARK_SIZES[0]
+  smallestPath = os.path.join(benchmarkDir, "Benchmark_{}x{}.band".format(sectionCount, eventsPerSection))
+  report["golden"] = compareDecoders(smallestPath, options)
+  for decoderName, differentFiles in report["golden"].items():
+    print("{} decoder {} the golden output".format(decoderName, "differs from" if differentFiles else "matches"))
+    if(differentFiles):
+      bSame = False
+  
+  with open(reportPath, "w") as reportFile:
+    json.dump(report, reportFile, indent = 2)
+  print("Wrote benchmark report to {}".format(reportPath))
+  return bSame
 
 def dumphex(dataLength, s):
   originalPosition = s.pos
+  dumpbytes(s.read("bytes:{}".format(dataLength)), 0, dataLength)
+  s.pos = originalPosition
+
+def dumpbytes(buf, start, dataLength):
+  print(formatBytes(buf, start, dataLength))
+
+def formatBytes(buf, start, dataLength):
   byteCounter = 0
   hexDump = ""
   for lineOffset in range(0, dataLength, 16):
@@ -71,7 +2990,7 @@ def dumphex(dataLength, s):
     
     bytesToRead = min(16, dataLength - lineOffset)
     
-    for byte in s.readlist("{}*uint:8".format(bytesToRead)):      
+    for byte in buf[start + lineOffset:start + lineOffset + bytesToRead]:      
       if(byte in canBePrinted):
         asciiString += chr(byte)
       else:
@@ -83,20 +3002,143 @@ def dumphex(dataLength, s):
       if (byteCounter == dataLength):
         break        
     hexDump += "0x{:08X} | {:48}| {:16} |\n".format(lineOffset, hexString, asciiString)
-  s.pos = originalPosition
-  print(hexDump)
+  return hexDump
 
-WORKING_DIR = "GB_Extract_" + time.strftime("%Y%m%d-%H%M%S")
 # These offsets are in bits!
 TEMPO_OFFSET = 0x550 # 0xAA bytes
 TIME_SIGNATURE_OFFSET = 0x7D0 # 0xFA bytes
 TIME_SIGNATURE_OFFSET_2 = 0x1DB6
+# projectData is read and decoded in chunks of this many bytes
+LOAD_CHUNK_SIZE = 0x100000
+# Amount of base64 text gathered before it is decoded
+DECODE_CHUNK_SIZE = 0x40000
+# Decoded data larger than this is kept in a memory mapped temporary file rather
+# than in memory
+DECODED_MMAP_THRESHOLD = 0x4000000
 BASE_TIME = 0x9600
+# Sections and events per section of the synthetic projects used by --benchmark
+BENCHMARK_SIZES = [(4, 1000), (16, 10000), (32, 50000)]
+# At most this many files per write thread are queued to be written before decoding
+# waits for them
+WRITE_QUEUE_DEPTH = 2
+# Sections are only decoded in parallel if there is at least this many bytes of MIDI data
+# blocks, as starting the worker processes takes longer than decoding a small project
+PARALLEL_DECODE_THRESHOLD = 0x200000
+# --watch checks for a save this often, in seconds, and only extracts a project once its
+# projectData has not changed for WATCH_SETTLE_TIME seconds
+WATCH_POLL_INTERVAL = 0.25
+WATCH_SETTLE_TIME = 1.0
+# Modules which are only imported when needed, which --benchmark checks are not imported
+# along with the script
+LAZY_MODULES = ["numpy", "midiutil", "bitstring", "multiprocessing", "concurrent.futures", "zipfile",
+                "argparse", "tempfile", "random", "xml.etree.ElementTree", "dialogs", "console"]
+# Ways of writing the MIDI of a project, see SectionWriter
+OUTPUT_FORMATS = ["files", "zip", "smf", "none"]
+# What is written for a section whose data is identical to an earlier section's: a copy
+# of its MIDI, a hard link to its file or only an entry in GB_Extract_Aliases.json
+IDENTICAL_SECTION_MODES = ["copy", "link", "alias"]
+ALIASES_FILENAME = "GB_Extract_Aliases.json"
+# Which of a set of identical notes on the same tick is kept: the first, the longest or
+# the loudest
+DUPLICATE_POLICIES = ["drop", "longest", "loudest"]
+# Bytes dumped before and from the offset of an error stepped over by recovery mode
+DIAGNOSTIC_DUMP_BEFORE = 48
+DIAGNOSTIC_DUMP_AFTER = 32
+# Formats of the analysis export of the decoded events
+ANALYSIS_FORMATS = ["npz", "jsonl"]
+# Incremental extraction keeps a manifest of what was written in the output directory
+MANIFEST_FILENAME = "GB_Extract_Manifest.json"
+MANIFEST_VERSION = 1
+# The events of every section decoded for --profiles, see EventCache
+EVENT_CACHE_FILENAME = "GB_Extract_Events.bin"
+EVENT_CACHE_MAGIC = b"GBEC"
+EVENT_CACHE_VERSION = 1
+# Magic, version, length of the JSON header and number of events
+EVENT_CACHE_HEADER = struct.Struct("<4sIII")
 VALID_BLOCKS = [b"\x2e\x03\x41",
                 b"\x3c\x03\x41", 
                 b"\x64\x03\x41",
                 b"\x2e\x03\x01"]
 
+# Markers found at the start of each record that we are interested in.  All of these
+# are found by a single scan of the data so adding one here does not add another pass.
+RECORD_MARKERS = [b"qSvE",  # 0x71537645
+                  b"qeSM"]  # 0x7165534D
+                  #b"kraT", # 0x6B617254
+                  #b"tSnI", # 0x74536e49
+                  #b"tSxT", # 0x74537854
+                  #b"ivnE"] # 0x69766e45
+
+# Precompiled record layouts used by the struct decoder.  These mirror the bitstring
+# format strings used by the reference decoder.
+RECORD_HEADER = struct.Struct("<4xHIII10xI4x")
+SECTION_HEADER = struct.Struct("<3s5xI4xH")
+# Note on (0x9x) immediately followed by its note off (0x8x) and duration
+NOTE_PAIR = struct.Struct("<B3xI3xBB3x7xBII")
+TWO_PART_EVENT = struct.Struct("<4xI3xBB3x")
+EVENT_SIZE = 16
+
+# SMFWriter packs each event into an int: tick above SMF_KEY_TICK_SHIFT, then the sort
+# order of the event class, insertion order, status byte and two data bytes.  The sort
+# orders are those MIDIUtil uses so that events at the same tick are written in the same
+# order.
+SMF_KEY_TICK_SHIFT = 60
+SMF_KEY_EVENT_MASK = (1 << SMF_KEY_TICK_SHIFT) - 1
+SMF_ORDER_META = 0
+SMF_ORDER_CHANNEL = 1
+SMF_ORDER_NOTE_OFF = 2
+SMF_ORDER_NOTE_ON = 3
+SMF_ORDER_TEMPO = 3
+SMF_ORDER_ZERO_NOTE_OFF = 4
+
+# Event classes, indexed by command byte, used by the NumPy decoder and the --profile
+# report.  0x51-0x5F are treated as unknown as the struct decoder reports them as an error.
+EVENT_UNKNOWN = 0
+EVENT_END = 1
+EVENT_SKIP = 2
+EVENT_NOTE = 3
+EVENT_CC = 4
+EVENT_PRESSURE = 5
+EVENT_PITCH_BEND = 6
+
+# Names of the event classes used by the --profile report
+EVENT_FAMILY_NAMES = ["unknown", "end", "skipped", "note", "cc", "pressure", "pitchBend"]
+
+def buildEventKindTable(eventClasses = None):
+  # Event class of each command byte.  Classes not in eventClasses, a list of names from
+  # EVENT_FAMILY_NAMES, are skipped like any other event that has no MIDI.
+  eventKinds = [EVENT_UNKNOWN] * 256
+  for midiCmd in range(256):
+    if(midiCmd >= 0x90 and midiCmd <= 0x9F):
+      eventKinds[midiCmd] = EVENT_NOTE
+    elif((midiCmd >= 0x00 and midiCmd <= 0x0A) or midiCmd == 0xFF or
+         (midiCmd >= 0x20 and midiCmd <= 0x2F) or midiCmd == 0x40 or midiCmd == 0x50 or
+         (midiCmd >= 0x70 and midiCmd <= 0x8F) or
+         (midiCmd >= 0xA0 and midiCmd <= 0xAF) or
+         (midiCmd >= 0xC0 and midiCmd <= 0xCF)):
+      eventKinds[midiCmd] = EVENT_SKIP
+    elif(midiCmd >= 0xB0 and midiCmd <= 0xBF):
+      eventKinds[midiCmd] = EVENT_CC
+    elif(midiCmd >= 0xD0 and midiCmd <= 0xDF):
+      eventKinds[midiCmd] = EVENT_PRESSURE
+    elif(midiCmd >= 0xE0 and midiCmd <= 0xEF):
+      eventKinds[midiCmd] = EVENT_PITCH_BEND
+    elif((midiCmd >= 0x30 and midiCmd <= 0x3F) or midiCmd in (0x11, 0x12, 0x60, 0xF1)):
+      eventKinds[midiCmd] = EVENT_END
+    if(eventClasses != None and eventKinds[midiCmd] >= EVENT_NOTE and
+       EVENT_FAMILY_NAMES[eventKinds[midiCmd]] not in eventClasses):
+      eventKinds[midiCmd] = EVENT_SKIP
+  return eventKinds
+
+EVENT_KIND_TABLE = buildEventKindTable()
+# Bytes taken by the event for each command byte that has a fixed length
+EVENT_LENGTHS = [2 * EVENT_SIZE if (midiCmd & 0xF0) in (0x70, 0x90) else EVENT_SIZE for midiCmd in range(256)]
+# Event classes which can be chosen with eventClasses
+SELECTABLE_EVENT_CLASSES = EVENT_FAMILY_NAMES[EVENT_NOTE:]
+
+# Set by loadNumpy()
+EVENT_DTYPE = None
+
 ####################################
 ### User-configurable parameters ###
 ####################################
@@ -121,7 +3163,7 @@ bUniqueTracks = False
 # If you know that you only have n instruments in your kit then you can set this number
 # to limit the number of tracks created.  If more notes are found than tracks then new notes are
 # added in a round-robin way, starting again from track zero.  The theoretical max value
-# is 128.
+# is 128.  Set this to None to create as many tracks as each section has notes.
 if(bUniqueTracks):
   trackLimit = 16
 else:
@@ -190,6 +3232,135 @@ trackMap = {35:'Kick',
 # the MIDI starts exactly with the first note.
 baseTime = BASE_TIME
       
+## Decoder ##
+
+# The original bitstring decoder is much slower but is kept as a reference.  Set this to
+# True to use it instead of the struct decoder, e.g. to check a change to the decoder.
+bReferenceDecoder = False
+# Set to True to decode each MIDI data block as whole NumPy arrays, which is much faster
+# for projects with a lot of CC and pitch bend data.  Requires numpy.  Blocks that the
+# NumPy decoder does not understand are passed to the struct decoder instead.
+bNumpyDecoder = False
+# Number of processes used to decode the sections of a large project at the same time.
+# None uses one per CPU and 1 decodes the sections one after another.  Pythonista cannot
+# start processes so 1 is always used there.  The same as the --decode-jobs option.
+decodeJobs = None
+
+## MIDI writer ##
+
+# MIDI files are written by a built-in writer which is much faster than MIDIUtil.  Set this
+# to True to use MIDIUtil instead, which must then be installed.  Both give the same MIDI
+# events, which can be checked with the --compare-writers option.
+bMidiUtilWriter = False
+
+## Output ##
+
+# "files" writes one MIDI file per section.  "zip" writes the same files into one
+# <project name>.zip and "smf" writes one <project name>.mid with a track for each section,
+# either of which is much quicker than many small files on slow storage such as iCloud
+# Drive.  The same as the --output-format option.
+outputFormat = "files"
+# Number of threads writing MIDI files while the next sections are decoded, or 0 to write
+# each file before decoding the next section.  The same as the --write-jobs option.
+writeJobs = 4
+
+## Analysis export ##
+
+# Set to "npz" to also write the decoded events of each section as NumPy arrays, one per
+# column, or "jsonl" to write them as JSON Lines with one object per event.  This is much
+# quicker than reading the events back from the MIDI files.  "npz" requires numpy.  Use
+# outputFormat "none" to only write the analysis export.  The same as --analysis-format.
+analysisFormat = None
+
+## Render profiles ##
+
+# Each profile is a set of the options above, named as in ExtractOptions, which are used
+# in place of them to write the project again to a directory named after the profile.
+# profileNames chooses which profiles are written, e.g. ["combined", "stems"], or None to
+# extract as normal.  The project is only decoded once, to GB_Extract_Events.bin in the
+# working directory, and every profile is written from that.  Later runs to the same
+# directory use it again until the project is saved.  The same as the --profiles option.
+renderProfiles = {"combined": {},
+                  "stems": {"bUniqueTracks": True, "trackLimit": None},
+                  "bend": {"bOverridePitchBend": True},
+                  "aligned": {"baseTime": None}}
+profileNames = None
+
+## Incremental extraction ##
+
+# If set to True then the MIDI is written to a GB_Extract_<project name> directory that
+# is reused on every run, and only sections which have changed since the last run are
+# decoded and written again.  The same as the --incremental option.
+bIncremental = False
+
+## Section selection ##
+
+# Only these sections are decoded and written, or all of them if None.  Each entry is
+# either a regular expression matched against the section name, e.g. "Drums", or a record
+# number or MIDI ID as shown by --list.  The same as the --select option.
+selectSections = None
+
+## Event classes ##
+
+# Only these classes of event are written, or all of them if None.  Choose from "note",
+# "cc", "pressure" and "pitchBend", e.g. ["note"] for drum parts.  The other classes are
+# stepped over without being decoded so this is also faster.  The same as the
+# --event-classes option.
+eventClasses = None
+
+## Duplicate events ##
+
+# By default a note is only dropped if it repeats the note just before it, which works
+# around https://github.com/MarkCWirt/MIDIUtil/issues/24 and matches the MIDI written by
+# earlier versions.  Set this to "drop", "longest" or "loudest" to remove every note, CC,
+# pressure or pitch bend event identical to another on the same tick anywhere in the
+# section, e.g. in sections with several takes, keeping the first, the longest or the
+# loudest note.  CC, pressure and pitch bend events are only duplicates if they have the
+# same value.  The same as the --duplicates option.
+duplicatePolicy = None
+# If set to True then notes of different lengths are not duplicates of each other
+bDuplicateDuration = False
+
+## Identical sections ##
+
+# Sections copied from one another, or recorded as several identical takes, have
+# identical data.  Set this to "copy" to only decode the first of them and write its
+# events for the others too, with their own track names, "link" to hard link the others
+# to its MIDI file instead, where the file system allows, so they have the track names of
+# the first but an analysis export of their own, or "alias" to only list the others in GB_Extract_Aliases.json along with the
+# file they are the same as.  The same as the --identical-sections option.
+identicalSections = None
+
+## Controller thinning ##
+
+# Synth and playable guitar parts can record thousands of CC, pressure and pitch bend
+# events which make the MIDI files large and slow to load.  If set to True then events
+# which repeat the value before them are removed, which makes no difference to what is
+# played.  thinValueTolerance also removes events within that many steps of the last
+# value kept, with pitch bends using steps 128 times as large, and thinTimeTolerance
+# keeps at most about one event per that many ticks (960 to a quarter note).  The first
+# and last event of each controller and the values in effect when each note starts and
+# ends are always kept.  The same as the --thin-controllers, --thin-value and --thin-time
+# options.
+bThinControllers = False
+thinValueTolerance = 0
+thinTimeTolerance = 0
+
+## Error recovery ##
+
+# If set to True then a MIDI data block or record which cannot be decoded is skipped,
+# with a warning, rather than stopping the extraction, and the rest of the project is
+# extracted as normal.  Each error is recorded in the result, and in the summary of a
+# batch, with its offset, command and a dump of the data around it.  The same as the
+# --recover option.
+bRecover = False
+
+## Progress ##
+
+# If set to True then a line is printed as each section is decoded, which is useful to
+# see how far a long extraction has got on iOS.  The same as the --progress option.
+bShowProgress = False
+
 ## Debugging ##
 
 # Turn debugging on or off
@@ -199,6 +3370,12 @@ bDebug = False
 bWriteToFile = False
 # If this is set then the whole binary is dumped as hex text at the end of processing
 bDumpFile = False
+# If this is set then the decoded project data is written to decoded.bin in the working
+# directory
+bWriteDecodedData = False
+# If this is set then event counts and the time taken by each phase of the extraction are
+# written to GB_Extract_Profile.json in the working directory.  The same as --profile.
+bProfile = False
 
 ########################################
 ### END User-configurable parameters ###
@@ -211,373 +3388,222 @@ bDumpFile = False
 #0x00000090 | 00 00 00 00 4C 10 00 00 00 00 08 09 00 00 06 00 | ....L........... | <- 4C = instrument, e.g. CF = pipa
 #0x000000A0 | 49 6E 73 74 20 31 2A 00 00 FF 00 01 00 00 00 00 | Inst.1*......... |
 
-trackCounter = 0
-trackDict = dict()
-recordHash = dict()
-
-try:
-  import dialogs
-  import console
-  bIsPythonista = True
-  debugPrint("Running inside of Pythonista")
-except:
-  bIsPythonista = False
-  debugPrint("Running outside of Pythonista")
-
 canBePrinted = bytes(string.ascii_letters + string.digits + string.punctuation, 'ascii')
 
-debugPrint("Creating working directory {} in {}".format(WORKING_DIR, os.getcwd()))
+# Found without importing them so that importing this script has no side effects
+bIsPythonista = (importlib.util.find_spec("dialogs") != None and importlib.util.find_spec("console") != None)
 
-try:
-  os.mkdir(WORKING_DIR)
-except OSError:
-  quitWithError("ERROR: Could not create working directory")
+def printProgress(sectionsDone, sectionCount, sectionLabel):
+  print("[{}/{}] {}".format(sectionsDone, sectionCount, sectionLabel))
 
-os.chdir(WORKING_DIR)
+def writeProfile(profilePath, workingDir, profileReport):
+  if(profilePath == None):
+    profilePath = os.path.join(workingDir, "GB_Extract_Profile.json")
+  with open(profilePath, "w") as profileFile:
+    json.dump(profileReport, profileFile, indent = 2)
+  print("Wrote profile to {}".format(profilePath))
 
-# Should we redirect stdout to a log file?
-if bWriteToFile:
-  origStdout = sys.stdout
-  newStdout = open("GB_Extract_Log.txt", 'w')
-  sys.stdout = newStdout
-
-if bIsPythonista: 
-  # Show iOS file picker to select GB file
-  fp = dialogs.pick_document(types=["public.item"])
-else:
-  if(len(sys.argv) == 2):
-    fp = sys.argv[1]
-  else:
-    quitWithError("ERROR: Expects a single argument which is the path to the GB project.band directory")
-
-if (fp != None):
-  pathToGBFile = os.path.join(fp, "projectData")
-else:
-  quitWithError("ERROR: No file selected.")
+def main():
+  import argparse
+  argParser = argparse.ArgumentParser(description="Extract music sections from GarageBand projects as MIDI")
+  argParser.add_argument("project", nargs="?", help="path to the GB project.band directory")
+  argParser.add_argument("--batch", metavar="DIR", help="extract every .band project found under DIR")
+  argParser.add_argument("--jobs", type=int, default=os.cpu_count(), help="number of projects extracted at once by --batch")
+  argParser.add_argument("--output", metavar="DIR", help="directory to write to instead of a new GB_Extract_<timestamp> directory")
+  argParser.add_argument("--watch", metavar="PROJECT", nargs="+", help="keep running and extract each PROJECT again every time it is saved")
+  argParser.add_argument("--profiles", metavar="NAMES", help="decode the project once and write it with each of these render profiles, separated by commas, or all of them with all")
+  argParser.add_argument("--incremental", action="store_true", help="only decode and write the sections that changed since the last run to the same directory")
+  argParser.add_argument("--output-format", choices=OUTPUT_FORMATS, default=outputFormat, help="write one MIDI file per section, one zip of them, one MIDI file with a track per section or no MIDI at all")
+  argParser.add_argument("--analysis-format", choices=ANALYSIS_FORMATS, default=analysisFormat, help="also write the decoded events of each section as NumPy arrays or JSON Lines for analysis")
+  argParser.add_argument("--write-jobs", type=int, default=writeJobs, help="number of threads writing MIDI files while decoding, 0 to write each file before decoding the next")
+  argParser.add_argument("--decode-jobs", type=int, default=decodeJobs, help="number of processes used to decode the sections of a large project, one per CPU by default")
+  argParser.add_argument("--profile", metavar="FILE", help="write event counts and the time taken by each phase to FILE as JSON")
+  argParser.add_argument("--progress", action="store_true", help="print a line as each section is decoded")
+  argParser.add_argument("--list", action="store_true", help="list the sections of the project without decoding or writing anything")
+  argParser.add_argument("--select", metavar="PATTERN", action="append", help="only extract sections whose name matches the regular expression PATTERN, or with the record number or MIDI ID PATTERN, can be given more than once")
+  argParser.add_argument("--event-classes", metavar="CLASSES", help="only write these classes of event, separated by commas, from note, cc, pressure and pitchBend")
+  argParser.add_argument("--duplicates", choices=DUPLICATE_POLICIES, default=duplicatePolicy, help="remove every event identical to another on the same tick, keeping the first, the longest or the loudest note")
+  argParser.add_argument("--duplicate-duration", action="store_true", help="with --duplicates, notes of different lengths are not duplicates")
+  argParser.add_argument("--identical-sections", choices=IDENTICAL_SECTION_MODES, default=identicalSections, help="only decode the first of several sections with identical data, and copy, hard link or alias its MIDI for the others")
+  argParser.add_argument("--thin-controllers", action="store_true", help="remove CC, pressure and pitch bend events that repeat the value before them")
+  argParser.add_argument("--thin-value", type=int, default=thinValueTolerance, help="with --thin-controllers, also remove events within this many steps of the last value kept")
+  argParser.add_argument("--thin-time", type=int, default=thinTimeTolerance, help="with --thin-controllers, keep at most about one event of each controller per this many ticks")
+  argParser.add_argument("--recover", action="store_true", help="skip sections which cannot be decoded, with a warning, and extract the rest of the project")
+  argParser.add_argument("--compare-decoders", action="store_true", help="check that every decoder gives the same MIDI as the reference decoder for the project, without writing anything")
+  argParser.add_argument("--generate", metavar="DIR", help="write a synthetic GB project to DIR, e.g. Test.band, for testing")
+  argParser.add_argument("--sections", type=int, default=8, help="number of sections in the project written by --generate")
+  argParser.add_argument("--events", type=int, default=1000, help="number of events in each section of the project written by --generate")
+  argParser.add_argument("--benchmark", metavar="DIR", help="benchmark extraction of synthetic projects of several sizes, kept in DIR")
+  argParser.add_argument("--compare-writers", action="store_true", help="check that the built-in MIDI writer and MIDIUtil give the same MIDI events for the project, without writing anything")
+  args = argParser.parse_args()
   
-if os.path.exists(pathToGBFile):
-  parseDataFile = ET.parse(pathToGBFile)
-  xmlRoot = parseDataFile.getroot()
-else:
-  quitWithError("ERROR: File does not exist: {}".format(pathToGBFile))
-
-# Decode the base64 data in the projectData file
-nsData = xmlRoot.find(".//*[key='NS.data']/data")
-encodedText = nsData.text
-try:
-  decodedData = base64.b64decode(encodedText)
-  with open("decoded.bin","wb") as fp:
-    fp.write(decodedData)
-except Exception as ex:
-  print(str(ex))
-  quitWithError("ERROR: Failed to decode data")
-
-# Open the decoded binary file for parsing
-s = ConstBitStream(filename='decoded.bin')
-s.pos = 0
-
-if bDebug: dumphex(0x800, s)
-
-# Pull out the tempo, offset is number of BITS
-s.pos = TEMPO_OFFSET
-preciseBPM = s.read('uintle:24')
-songTempo = preciseBPM/10000
-debugPrint("Tempo BPM is {} ({})".format(songTempo, hex(preciseBPM)))
-
-# Pull out the time signature 
-s.pos = TIME_SIGNATURE_OFFSET
-numerator = s.read('uintle:8')
-denominator = s.read('uintle:8')
-debugPrint("Time signature is {}/{}".format(numerator, 2**denominator))
-
-# Generate an ordered list of offsets pointing to bits of the 
-# binary data that we are interested in
-offset_list = list(s.findall('0x71537645', bytealigned = True)) #qSvE
-offset_list.extend(list(s.findall('0x7165534D', bytealigned = True))) #qeSM
-
-#offset_list.extend(list(s.findall('0x6B617254', bytealigned = True)))
-#offset_list.extend(list(s.findall('0x74536e49', bytealigned = True)))
-#offset_list.extend(list(s.findall('0x74537854', bytealigned = True)))
-#offset_list.extend(list(s.findall('0x69766e45', bytealigned = True)))
-sorted_offset_list = sorted(offset_list)
-
-for thisOffset in sorted_offset_list:
-  s.pos = thisOffset
-  
-  if bDebug:
-    debugPrint("Byte offset {}".format(thisOffset))
-    dumphex(64, s)
+  options = ExtractOptions()
+  options.bIncremental = (args.incremental or bIncremental)
+  options.decodeJobs = args.decode_jobs
+  options.outputFormat = args.output_format
+  options.writeJobs = args.write_jobs
+  options.analysisFormat = args.analysis_format
+  options.duplicatePolicy = args.duplicates
+  options.bRecover = (args.recover or bRecover)
+  options.bThinControllers = (args.thin_controllers or bThinControllers)
+  options.identicalSections = args.identical_sections
+  options.thinValueTolerance = args.thin_value
+  options.thinTimeTolerance = args.thin_time
+  options.bDuplicateDuration = (args.duplicate_duration or bDuplicateDuration)
+  options.bProfile = (args.profile != None or bProfile)
+  if(args.progress or bShowProgress):
+    options.progressCallback = printProgress
+  if(args.select != None):
+    options.selectSections = args.select
+  if(args.event_classes != None):
+    options.eventClasses = [eventClass.strip() for eventClass in args.event_classes.split(",")]
+  if(args.profiles == "all"):
+    options.profileNames = list(renderProfiles)
+  elif(args.profiles != None):
+    options.profileNames = [profileName.strip() for profileName in args.profiles.split(",")]
   
-  recordType, recordSubType, recordNumber, recordMidiID, dataLength = s.readlist("pad:32, uintle:16, uintle:32, uintle:32, uintle:32, 2*pad:32, pad:16, uintle:32, pad:32")
+  debugPrint("Running {} Pythonista", "inside of" if bIsPythonista else "outside of")
   
-  # We are now at the start of the data so save this position for later...
-  dataStart = s.pos
+  if(args.generate != None):
+    eventCount = generateProjectData(args.generate, args.sections, args.events)
+    print("Wrote {} sections with {} events to {}".format(args.sections, eventCount, args.generate))
+    sys.exit(0)
   
-  if bDebug:
-    debugPrint("Data length is: {} Type is: {} Record no: {} MIDI ID: {}".format(dataLength, recordType, recordNumber, recordMidiID))
-    if(recordType == 1 or recordType == 5): dumphex(dataLength, s)
-
-  # Test for a MIDI block header
-  blockType = s.read("bytes:3")
-
-  debugPrint("BlockType is {}".format(blockType.hex()))
+  if(args.benchmark != None):
+    sys.exit(0 if runBenchmark(args.benchmark, options) else 1)
+  
+  if(args.watch != None):
+    watchProjects(args.watch, args.output, options)
+    sys.exit(0)
   
-  # Is this a section header?
-  if(recordType == 2 and
-    (blockType in VALID_BLOCKS)):
-    associatedMidiID, sectionNameLength = s.readlist("pad:40, uintle:32, pad:32, uintle:16")
-    # Create a key from the record + associated midi ID
-    hashKey = createKey(str(recordNumber), str(associatedMidiID))
-    origSectionName = s.read("bytes:{}".format(str(sectionNameLength))).decode("utf-8")
+  if(args.batch == None):
+    if bIsPythonista: 
+      # Show iOS file picker to select GB file
+      import dialogs
+      fp = dialogs.pick_document(types=["public.item"])
+    elif(args.project != None):
+      fp = args.project
+    else:
+      quitWithError("ERROR: Expects a single argument which is the path to the GB project.band directory")
     
-    # Strip out filename unfriendly characters
-    sectionName = "".join(thisChar for thisChar in origSectionName if (thisChar.isalnum() or thisChar in "._- "))
+    if (fp == None):
+      quitWithError("ERROR: No file selected.")
     
-    debugPrint("Section name is {} (orig {}), hash key is {}".format(sectionName, origSectionName, hashKey))
-      
-    existingRecord = recordHash.get(hashKey)
-    # Validation - The key should be unique
-    if(existingRecord != None):
-      quitWithError("ERROR: Found second record for key {}".format(hashKey))
-
-    midiSection = MIDISection(sectionName, associatedMidiID, recordNumber)
-    recordHash[hashKey] = midiSection
-  elif(recordType == 1): # MIDI data block
-    hashKey = createKey(str(recordNumber), str(recordMidiID))    
-    debugPrint("Hash key is {}".format(hashKey))    
-    # Have we seen a section header with this MIDI ID?
-    midiSection = recordHash.get(hashKey)
-    if(midiSection != None):
-      debugPrint("Found MIDI data for section {}".format(midiSection.label))
-        
-      # Create a new MIDIFile object to store the notes for this MIDI section
-      midiFileData = MIDIFile(numTracks=trackLimit, ticks_per_quarternote=960, eventtime_is_ticks=True)
-      midiFileData.addTimeSignature(0, 0, numerator, denominator, clocks_per_tick = 24, notes_per_quarter=8)
-      midiFileData.addTempo(0, 0, songTempo)
-      midiFileData.addTrackName(0, 0, midiSection.label + "-" + str(recordNumber) + "_" + str(recordMidiID))
-      
-      trackCounter = 0
-      trackDict = dict()
-      midiEvent = None
-      lastMIDIEvent = None
-            
-      s.pos = dataStart     
-      
-      while True:
-        # Read in the next command byte
-        midiCmd = s.read('uintle:8')
-        debugPrint('Command is {} ({})'.format(midiCmd, hex(midiCmd)))
-        
-        midiChl = midiCmd & 0x0F
-        
-        if(midiCmd >= 0x90 and midiCmd <= 0x9F): # Note on/off event
-          # 0x00000000 | 90 00 00 00 00 96 00 00 00 00 00 7D 24 00 00 00 | ...........}$...
-          # 0x00000010 | 80 00 00 00 00 00 00 89 00 00 00 00 F0 00 00 00 | ................
-          
-          midiEvent = MIDIEvent(*s.readlist('pad:24, uintle:32, pad:24, uintle:8, uintle:8, uintle:24'))
-          s.read("bytes:7")
-          
-          midiCmd = s.read('uintle:8')
-          if(midiCmd >= 0x80 and midiCmd <= 0x8F): # Note Off event then set note duration event
-            # 0x00000580 | 40 00 00 00 00 00 00 89 00 00 00 00 F0 00 00 00 | @...............
-            # 0x00000590 | 00 00 00 00 00 00 00 A7 00 00 00 00 00 00 00 00 | ................
-            # 0x000005A0 | 90 00 00 00 53 BD 00 00 00 00 00 73 24 00 00 00 | ....S......s$...
-
-            extendedBytes = s.read("uintle:32")
-            # Duration spans at least 3, probably 4 bytes.  We'll go for 4 for now!
-            midiEvent.duration = s.read("uintle:32")
-            
-            if(baseTime == None):
-              baseTime = midiEvent.time
-               
-            bAddNote = True
+    if(args.list):
+      try:
+        sections = listProject(fp, options)
+      except ExtractError as ex:
+        quitWithError(str(ex))
+      print("{:<32} {:>8} {:>8} {:>10} {:>10} {:>8}".format("Section", "Record", "MIDI ID", "Offset", "Length", "Events"))
+      for section in sections:
+        print("{:<32} {:>8} {:>8} {:>#10x} {:>10} {:>8}{}".format(
+              section["label"], section["recordNumber"], section["associatedMidiID"], section["offset"],
+              section["dataLength"], section["estimatedEvents"], "" if section["selected"] else " (not selected)"))
+      sys.exit(0)
     
-            # Try and work around duplicate note bug https://github.com/MarkCWirt/MIDIUtil/issues/24
-            if(lastMIDIEvent != None):
-              if(lastMIDIEvent.note == midiEvent.note and
-                 lastMIDIEvent.time == midiEvent.time):
-                 bAddNote = False
-                  
-            if(bAddNote):
-              # Default track zero
-              trackToUse = 0
-              if(bUniqueTracks):
-                trackToUse = trackDict.get(midiEvent.note)
-                if(trackToUse == None):
-                  trackToUse = trackCounter
-                  trackDict[midiEvent.note] = trackToUse
-                  noteName = None
-                  
-                  # Track name appended with mapped instrument name or MIDI note number
-                  if(bRenameTracks):
-                    noteName = trackMap.get(midiEvent.note)
-                  
-                  if(noteName == None):
-                    noteName = str(midiEvent.note)
-                    
-                  trackName = noteName + "_" + midiSection.label + "-" + str(recordNumber) + "_" + str(recordMidiID) + "_" + noteName
-                  midiFileData.addTrackName(trackToUse, 0, trackName)
-                  trackCounter += 1
-                  
-                  if(trackCounter >= trackLimit):
-                    debugPrint("Resetting track counter")
-                    trackCounter = 0
-                    
-                  debugPrint("trackToUse {} {}".format(trackToUse, trackName))
-                        
-              midiFileData.addNote(trackToUse, midiChl, midiEvent.note, midiEvent.time - baseTime, midiEvent.duration, midiEvent.velocity)
-              debugPrint(midiEvent.__dict__)
-              midiEvent.trackUsed = trackToUse
-              lastMIDIEvent = midiEvent
-              midiSection.bHasMIDI = True
-                          
-            if(extendedBytes > 0):
-              debugPrint('Found extended bytes {} '.format(hex(extendedBytes)))
-              
-          else: # Did not find expected 0x8x before note duration data
-            quitWithError('ERROR: Unknown command {} ({})'.format(midiCmd, hex(midiCmd)))
-        elif ((midiCmd >= 0x00 and midiCmd <= 0x0A) or midiCmd == 0xFF): # internal commands/screen elements?
-          # 00 00 00 00 00 00 01 B5 00 00 00 00 00 00 00 00. button on? 01 on 02 off
-          s.read('bytes:6')
-          midiCmd = s.read('uintle:8')
-          if (midiCmd != 0xA8 and midiCmd != 0xA7 and midiCmd != 0xB5):
-            debugPrint('WARN: Unknown command {} ({})'.format(midiCmd, hex(midiCmd)))            
-          s.read('bytes:8')
-        elif (midiCmd >= 0x20 and midiCmd <= 0x2F): # cc bank change ?
-          # 20 3D 01 00 00 00 00 A8 00 00 00 00 A5 83 00 00
-          s.read("bytes:15")
-        elif (midiCmd == 0x40): # cc sustain ?
-          # 40 2F 01 00 00 00 00 A8 00 00 00 00 A2 83 00 00
-          s.read("bytes:15")
-        elif (midiCmd >= 0x50 and midiCmd <= 0x5F): # cc general purpose controller, synth knobs 0x00-0x0b pads CA-CD
-          # 50 40 00 00 00 96 00 00 10 58 39 0E 00 01 00 01 # knob top left synth 00 
-          # 50 40 00 00 00 96 00 00 45 B6 D3 0C 01 01 00 01 # knob bottom left 01
-          # 50 40 00 00 00 96 00 00 00 00 00 7F 02 01 00 01 # knob top right 02
-          # 50 40 00 00 00 96 00 00 00 00 00 00 07 01 00 01 # knob bottom right 07
-          
-          if (midiCmd >= 0x51 and midiCmd <= 0x5F): # I do not think this is actually per-channel so validate this
-            quitWithError("Unexpected 0x5x command {} ({})".format(midiCmd, hex(midiCmd)))
-          
-          thisEvent = readTwoPartEvent(s)
-          
-          # It feels like program change, e.g. patch change in synth is implemented like this but GB does not respond
-          # so disabling this for now.
-          if(False and thisEvent.valueB & 0xC0 == 0xC0):
-            ctrlChl = thisEvent.valueB & 0x0F
-            debugPrint("Adding program change")
-            midiFileData.addProgramChange(0, ctrlChl, thisEvent.time - baseTime, thisEvent.valueA)
-        
-        elif (midiCmd >= 0x70 and midiCmd <= 0x7F): # can be triggered by manually adding and moving percussion with smart drums while recording
-          # 70 00 00 00 00 96 00 00 00 00 00 01 36 00 00 00
-          # 09 00 02 06 00 00 00 A8 00 00 00 00 21 00 09 00
-          debugPrint("0x7x MIDI command {} ({})".format(midiCmd, hex(midiCmd)))            
-          s.read("bytes:31")
-        elif (midiCmd >= 0x80 and midiCmd <= 0x8F): # Do not know what this is. Seen with synth, not a note-off though as it uses the same bytes each time.
-          # 80 AE 01 00 00 00 00 A8 00 00 00 00 A5 83 00 00
-          s.read("bytes:15")
-        elif (midiCmd >= 0xA0 and midiCmd <= 0xAF): # polyphonic key pressure unsupported in MIDIUtil API :(
-          # A0 11 01 00 00 00 00 A8 00 00 00 00 A5 83 00 00
-          debugPrint("Polyphonic key pressure (unsupported) {}({})".format(midiCmd, hex(midiCmd)))
-          s.read("bytes:15")
-        elif (midiCmd >= 0xB0 and midiCmd <= 0xBF): # MIDI CC
-          # B0 40 00 00 5D 9D 00 00 00 00 00 00 40 00 00 01 cc sustain off 00 40 ch 0 40 is cc val
-          # B0 40 00 00 5D 9D 00 00 00 00 00 7F 40 00 00 01 cc sus on 7F 40 ch 0
-          # 0 (to 63) is off. 127 (to 64) is on.
-          # B0 40 00 00 40 9A 00 00 00 00 00 00 01 00 00 01 cc mod wheel zero
-          
-          thisEvent = readTwoPartEvent(s)
-          midiFileData.addControllerEvent(0, midiChl, thisEvent.time - baseTime, thisEvent.valueB, thisEvent.valueA)
-          midiSection.bHasMIDI = True
-        elif (midiCmd >= 0xC0 and midiCmd <= 0xCF): # Should be program change but don't think it is 
-          # C0 03 01 00 00 00 00 A8 00 00 00 00 A5 83 00 00
-          s.read("bytes:15")
-        elif (midiCmd >= 0xD0 and midiCmd <= 0xDF): # channel pressure
-          # D3 40 00 00 81 A1 00 00 00 00 00 00 00 00 00 01 channel pressure 0
-          # D5 40 00 00 C4 BA 00 00 00 00 00 1F 1F 00 00 01 channel pressure 1F
-          
-          thisEvent = readTwoPartEvent(s)
-          
-          if(thisEvent.valueA != thisEvent.valueB):
-            quitWithError("Pressure value A ({}) != Pressure value B ({})".format(thisEvent.valueA, thisEvent.valueB))
-
-          # This method does not appear to be documented but is in the MIDIUtil unit tests and the
-          # changelog says it was added in 1.2.1          
-          midiFileData.addChannelPressure(0, midiChl, thisEvent.time - baseTime, thisEvent.valueA)
-          midiSection.bHasMIDI = True       
-        elif (midiCmd >= 0xE0 and midiCmd <= 0xEF): # pitch bend
-          # E8 40 00 00 19 A0 00 00 00 00 00 40 17 00 00 01 pitch bend ch 8 val 40 17
-          # E4 40 00 00 41 9A 00 00 00 00 00 40 00 00 00 01 pitch bend 0
-          
-          thisEvent = readTwoPartEvent(s)
-          
-          pb = 0
-          pb = (pb << 7) + (thisEvent.valueA & 0x7F)
-          pb = (pb << 7) + (thisEvent.valueB & 0x7F)
-          pitchWheelValue = -8192 + pb
-
-          if(bOverridePitchBend):
-            pitchWheelValue *= pitchBendMultiplier
-            # Correct any overshoot
-            if(pitchWheelValue < -8192): pitchWheelValue = -8192
-            if(pitchWheelValue > 8191): pitchWheelValue = 8191
-            debugPrint("Adjusted pitchWheelValue is: {}({})".format(pitchWheelValue, hex(pitchWheelValue)))
-
-          midiFileData.addPitchWheelEvent(0, midiChl, thisEvent.time - baseTime, pitchWheelValue)
-          midiSection.bHasMIDI = True
-        elif (midiCmd == 0xF1):
-          debugPrint("Found end of buffer")
-          break
-        elif ((midiCmd >= 0x30 and midiCmd <= 0x3F) or
-               midiCmd == 0x60 or 
-               midiCmd == 0x11 or 
-               midiCmd == 0x12):
-          # These tend to be at the start of blocks we are not interested in
-          debugPrint("Unknown bytes: {}".format(hex(midiCmd)))
-          break
-        else:
-          # Not seen this command byte before so dump some context for debugging
-          # purposes then exit
-          s.pos -= (64 * 8)
-          dumphex(68, s)
-          quitWithError("Unrecognised command: {}".format(midiCmd))
-          break # Unreachable
-
-        # Check we have not exceeded the length of the data in this block
-        bufferUsed = s.pos - dataStart
-        totalBufferSize = (dataLength * 8)
-        debugPrint("Buffer used so far: {} out of: {}".format(bufferUsed, totalBufferSize))
-        
-        if(bufferUsed > totalBufferSize):
-          quitWithError("ERROR: Went past end of buffer.")
-          
-        if(bufferUsed == totalBufferSize):
-          debugPrint("Used full buffer")
-          break
-      
-      if (midiSection.bHasMIDI):
-        midiSection.midiData = midiFileData
-
-for k,v in recordHash.items():
-  debugPrint("Key {} with value {} ".format(k, v.label))
-  midiFileData = v.midiData
-  if(midiFileData != None):
-    filename = "{}-{}_{}.mid".format(v.label, str(v.recordNumber), str(v.associatedMidiID))
-    # 'with open' means Python will automatically close the file
-    with open(filename, "wb") as output_file:
-      print("Writing MIDI to {}".format(filename))
-      midiFileData.writeFile(output_file)
-      
-if(bDumpFile):
-  s.pos = 0
-  fileSize = os.path.getsize('decoded.bin')
-  debugPrint("fileSize is {}".format(fileSize))
-  dumphex(fileSize, s)
-
-if bWriteToFile:
-  newStdout.close()
-  sys.stdout = origStdout
-
-if bIsPythonista:
-  console.hud_alert("File processing complete",'success', 1)
-else:
-  print("File processing complete")
+    if(args.compare_decoders):
+      try:
+        differentFiles = compareDecoders(fp, options)
+      except ExtractError as ex:
+        quitWithError(str(ex))
+      for decoderName in differentFiles:
+        for filename in differentFiles[decoderName]:
+          print("{} decoder differs from the reference decoder for {}".format(decoderName, filename))
+      if(any(differentFiles.values())):
+        quitWithError("ERROR: Decoders differ from the reference decoder")
+      print("{} decoders give the same MIDI as the reference decoder".format(", ".join(differentFiles)))
+      sys.exit(0)
+    
+    if(args.compare_writers):
+      try:
+        differentFiles = compareMidiWriters(fp, options)
+      except ExtractError as ex:
+        quitWithError(str(ex))
+      for filename in differentFiles:
+        print("MIDI events differ for {}".format(filename))
+      if(len(differentFiles) > 0):
+        quitWithError("ERROR: MIDI writers differ for {} sections".format(len(differentFiles)))
+      print("MIDI writers give the same events")
+      sys.exit(0)
+  
+  workingDir = args.output
+  if(workingDir == None):
+    if(not options.bIncremental):
+      workingDir = "GB_Extract_" + time.strftime("%Y%m%d-%H%M%S")
+    elif(args.batch != None):
+      workingDir = "GB_Extract_Batch"
+    else:
+      workingDir = getStableOutputDir(fp)
+  
+  debugPrint("Creating working directory {} in {}", workingDir, os.getcwd())
+  
+  try:
+    os.makedirs(workingDir, exist_ok = (args.output != None or options.bIncremental))
+  except OSError:
+    quitWithError("ERROR: Could not create working directory")
+  
+  # Should we redirect stdout to a log file?
+  if bWriteToFile:
+    origStdout = sys.stdout
+    newStdout = open(os.path.join(workingDir, "GB_Extract_Log.txt"), 'w')
+    sys.stdout = newStdout
+  
+  if(args.batch != None):
+    results = runBatch(args.batch, workingDir, args.jobs, options)
+    if(options.bProfile):
+      writeProfile(args.profile, workingDir, [{"project": result.projectPath, "profile": result.profile} for result in results])
+    failedCount = len([result for result in results if result.error != None])
+    print("Batch complete, {} of {} projects extracted".format(len(results) - failedCount, len(results)))
+    partialResults = [result for result in results if result.error == None and len(result.diagnostics) > 0]
+    if(len(partialResults) > 0):
+      print("{} sections of {} projects skipped because of errors, see GB_Extract_Summary.json".format(
+            sum(result.failedSections for result in partialResults), len(partialResults)))
+    if bWriteToFile:
+      newStdout.close()
+      sys.stdout = origStdout
+    sys.exit(1 if failedCount > 0 else 0)
+  
+  options.outputDir = workingDir
+  try:
+    result = extractProject(fp, options)
+  except ExtractError as ex:
+    quitWithError(str(ex))
+  
+  # Each render profile is written as if it were an extraction of its own
+  fileResults = list(result.profiles.items()) if len(result.profiles) > 0 else [(None, result)]
+  for profileName, fileResult in fileResults:
+    if(fileResult.archiveFile != None):
+      print("Wrote MIDI for {} sections to {}".format(len(fileResult.midiFiles), fileResult.archiveFile))
+    else:
+      for filename in fileResult.midiFiles:
+        print("Wrote MIDI to {}".format(filename if profileName == None else profileName + "/" + filename))
+  for filename in result.analysisFiles:
+    print("Wrote events to {}".format(filename))
+  if(len(result.unchangedFiles) > 0):
+    print("{} sections unchanged since the last extraction".format(len(result.unchangedFiles)))
+  if(len(result.aliases) > 0):
+    print("{} sections identical to others are listed in {}".format(len(result.aliases), ALIASES_FILENAME))
+  if(options.bThinControllers and result.thinnedControllerEvents > 0):
+    print("Thinned {} controller events to {} ({:.1f}x fewer)".format(result.controllerEvents, result.thinnedControllerEvents,
+                                                                      result.controllerEvents / result.thinnedControllerEvents))
+  if(len(result.diagnostics) > 0):
+    diagnosticsPath = os.path.join(workingDir, "GB_Extract_Diagnostics.json")
+    with open(diagnosticsPath, "w") as diagnosticsFile:
+      json.dump(result.diagnostics, diagnosticsFile, indent = 2)
+    print("Skipped {} errors, {} of {} sections could not be extracted, see {}".format(
+          len(result.diagnostics), result.failedSections, len(result.sectionLabels), diagnosticsPath))
+  if(options.bProfile):
+    writeProfile(args.profile, workingDir, result.profile)
+  
+  if bWriteToFile:
+    newStdout.close()
+    sys.stdout = origStdout
+  
+  if bIsPythonista:
+    import console
+    console.hud_alert("File processing complete",'success', 1)
+  else:
+    print("File processing complete")
+
+if __name__ == "__main__":
+  main()